@@ -0,0 +1,221 @@
+import datetime
+import json
+import os
+import re
+import sys
+
+import numpy as np
+
+# Columnar snapshots of chats for the heavier year-in-review analytics.
+#
+# Every chat gets a directory of flat binary columns, one file per column:
+#
+#     messages: message.id (i8), date (i8, unix time), user (i8), links (i2)
+#     tag rows: tag.message (i4, row in messages), tag.id (i4, index in meta.json tags)
+#     url rows: url.message (i4, row in messages), url.service (i1, index in SERVICES)
+#
+# refresh() only appends messages newer than the last snapshotted one, and
+# meta.json (written last) holds the row counts, so an interrupted refresh
+# is simply redone. The columns are memory-mapped for the reports, which are
+# all vectorized numpy operations. Edits of already snapshotted messages are
+# not picked up.
+#
+#     python analytics.py refresh -1001234567890
+
+SERVICES = [
+    ('other', None),
+    ('spotify', re.compile(r'^https://open.(spotify)\.com.+$')),
+    ('youtube', re.compile(r'^https://.*?(youtu.?be).+$')),
+    ('deezer', re.compile(r'^https://.*?(deezer)\.com.+$')),
+    ('itunes', re.compile(r'^https://(itunes)\.apple\.com.+$')),
+    ('google', re.compile(r'^https://play\.(google)\.com.+$')),
+    ('soundcloud', re.compile(r'^https://(soundcloud)\.com.+$')),
+]
+
+MESSAGE_COLUMNS = {'message.id': np.int64, 'date': np.int64, 'user': np.int64, 'links': np.int16}
+TAG_COLUMNS = {'tag.message': np.int32, 'tag.id': np.int32}
+URL_COLUMNS = {'url.message': np.int32, 'url.service': np.int8}
+
+
+def service_of(url):
+    for i, (_, pattern) in enumerate(SERVICES):
+        if pattern is not None and pattern.match(url):
+            return i
+    return 0
+
+
+class Snapshot(object):
+    def __init__(self, directory):
+        self.directory = directory
+        try:
+            with open(os.path.join(directory, 'meta.json')) as f:
+                self.meta = json.load(f)
+        except FileNotFoundError:
+            self.meta = {'last_id': 0, 'messages': 0, 'tag_rows': 0, 'url_rows': 0, 'tags': []}
+
+    def _path(self, column):
+        return os.path.join(self.directory, column)
+
+    def _column(self, column, dtype, count):
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self._path(column), dtype=dtype, mode='r', shape=(count,))
+
+    def columns(self):
+        m = self.meta
+        return {
+            **{c: self._column(c, t, m['messages']) for c, t in MESSAGE_COLUMNS.items()},
+            **{c: self._column(c, t, m['tag_rows']) for c, t in TAG_COLUMNS.items()},
+            **{c: self._column(c, t, m['url_rows']) for c, t in URL_COLUMNS.items()},
+        }
+
+    @property
+    def tags(self):
+        return self.meta['tags']
+
+    def refresh(self, d, chat_id, chunk_size=10000):
+        """Appends the messages stored since the last refresh; returns their number."""
+        os.makedirs(self.directory, exist_ok=True)
+        meta = dict(self.meta, tags=list(self.meta['tags']))
+        tag_ids = {t: i for i, t in enumerate(meta['tags'])}
+
+        # drop whatever an interrupted refresh might have left behind
+        sizes = [
+            (MESSAGE_COLUMNS, meta['messages']),
+            (TAG_COLUMNS, meta['tag_rows']),
+            (URL_COLUMNS, meta['url_rows']),
+        ]
+        for columns, count in sizes:
+            for c, t in columns.items():
+                with open(self._path(c), 'ab') as f:
+                    f.truncate(count * np.dtype(t).itemsize)
+
+        added = 0
+        for chunk in d.messages_since(chat_id, meta['last_id'], chunk_size):
+            rows = {c: [] for c in [*MESSAGE_COLUMNS, *TAG_COLUMNS, *URL_COLUMNS]}
+            for r in chunk:
+                row = meta['messages'] + len(rows['message.id'])
+                urls = r['urls'] or []
+                rows['message.id'].append(r['id'])
+                rows['date'].append(int(r['date'].replace(tzinfo=datetime.timezone.utc).timestamp()))
+                rows['user'].append(r['from'])
+                rows['links'].append(len(urls))
+                for t in r['hashtags'] or []:
+                    if t not in tag_ids:
+                        tag_ids[t] = len(meta['tags'])
+                        meta['tags'].append(t)
+                    rows['tag.message'].append(row)
+                    rows['tag.id'].append(tag_ids[t])
+                for u in urls:
+                    rows['url.message'].append(row)
+                    rows['url.service'].append(service_of(u))
+
+            for columns in (MESSAGE_COLUMNS, TAG_COLUMNS, URL_COLUMNS):
+                for c, t in columns.items():
+                    with open(self._path(c), 'ab') as f:
+                        np.asarray(rows[c], dtype=t).tofile(f)
+
+            meta['messages'] += len(rows['message.id'])
+            meta['tag_rows'] += len(rows['tag.id'])
+            meta['url_rows'] += len(rows['url.service'])
+            meta['last_id'] = rows['message.id'][-1]
+            added += len(chunk)
+
+        with open(self._path('meta.json.tmp'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(self._path('meta.json.tmp'), self._path('meta.json'))
+        self.meta = meta
+        return added
+
+
+def snapshot_of(chat_id):
+    return Snapshot(os.path.join(os.environ.get('ANALYTICS_DIR', 'analytics'), str(chat_id)))
+
+
+def year_in_review(snapshot, year, top=5):
+    """All reports of the year, computed over the memory-mapped columns."""
+    c = snapshot.columns()
+    start = int(datetime.datetime(year, 1, 1, tzinfo=datetime.timezone.utc).timestamp())
+    end = int(datetime.datetime(year + 1, 1, 1, tzinfo=datetime.timezone.utc).timestamp())
+
+    in_year = (c['date'] >= start) & (c['date'] < end)
+    dates, users = np.asarray(c['date'][in_year]), np.asarray(c['user'][in_year])
+    days = dates // 86400
+
+    # weekday x hour heatmap; 1970-01-01 was a Thursday
+    weekday = (days + 3) % 7
+    hour = (dates // 3600) % 24
+    heatmap = np.bincount(weekday * 24 + hour, minlength=7 * 24).reshape(7, 24)
+
+    # tag co-occurrence: pairs of tags of the same message
+    tag_in_year = in_year[c['tag.message']]
+    messages, tags = np.asarray(c['tag.message'][tag_in_year]), np.asarray(c['tag.id'][tag_in_year])
+    order = np.lexsort((tags, messages))
+    messages, tags = messages[order], tags[order]
+    pairs = [np.zeros(0, dtype=np.int64)]
+    offset = 1
+    while offset < len(messages):
+        same = messages[offset:] == messages[:-offset]
+        if not same.any():
+            break
+        pairs.append(tags[:-offset][same].astype(np.int64) * len(snapshot.tags) + tags[offset:][same])
+        offset += 1
+    pairs = np.concatenate(pairs)
+    keys, counts = np.unique(pairs, return_counts=True)
+    best = np.argsort(-counts, kind='stable')[:top]
+    cooccurrence = [
+        (*sorted([snapshot.tags[k // len(snapshot.tags)], snapshot.tags[k % len(snapshot.tags)]]), int(n))
+        for k, n in zip(keys[best], counts[best])
+    ]
+
+    # longest streak of consecutive active days per user
+    active = np.unique(np.stack([users, days], axis=1), axis=0)
+    breaks = np.ones(len(active), dtype=bool)
+    breaks[1:] = (active[1:, 0] != active[:-1, 0]) | (active[1:, 1] - active[:-1, 1] != 1)
+    runs = np.cumsum(breaks) - 1
+    lengths = np.bincount(runs)
+    run_users = active[breaks, 0]
+    streaks = {}
+    for u, n in zip(run_users.tolist(), lengths.tolist()):
+        streaks[u] = max(streaks.get(u, 0), n)
+    streaks = sorted(streaks.items(), key=lambda s: (-s[1], s[0]))[:top]
+
+    # share of every service per quarter
+    url_in_year = in_year[c['url.message']]
+    url_dates = np.asarray(c['date'])[np.asarray(c['url.message'][url_in_year])]
+    quarter = np.searchsorted(_quarter_starts(year), url_dates, side='right') - 1
+    services = np.asarray(c['url.service'][url_in_year]).astype(np.int64)
+    by_quarter = np.bincount(quarter * len(SERVICES) + services, minlength=4 * len(SERVICES)).reshape(4, len(SERVICES))
+
+    return {
+        'messages': int(in_year.sum()),
+        'heatmap': heatmap,
+        'cooccurrence': cooccurrence,
+        'streaks': streaks,
+        'services': [name for name, _ in SERVICES],
+        'services_by_quarter': by_quarter,
+    }
+
+
+def _quarter_starts(year):
+    return np.asarray([
+        int(datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc).timestamp())
+        for month in (1, 4, 7, 10)
+    ])
+
+
+def main(argv):
+    import db
+
+    if len(argv) != 2 or argv[0] != 'refresh':
+        print('Usage: python analytics.py refresh CHAT_ID')
+        return 2
+
+    chat_id = int(argv[1])
+    d = db.DB(full_uri=os.environ['DATABASE_URL'], replica_uri=os.environ.get('DATABASE_REPLICA_URL', ''))
+    print(f'Added {snapshot_of(chat_id).refresh(d, chat_id)} messages')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,301 @@
+import argparse
+import csv
+import datetime
+import io
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from sqlalchemy import text
+
+import db
+import migrations
+
+# Benchmarks for the DB report queries and the ingestion path over synthetic chats.
+#
+# Every scale is generated from scratch (deterministically, from --seed) into
+# BENCH_DATABASE_URL, which is wiped: never point it at real data. Results are
+# written as JSON and can be compared with an earlier run:
+#
+#     BENCH_DATABASE_URL=postgresql://localhost/bench python bench.py --scales 10000,100000 --output new.json
+#     python bench.py --compare old.json new.json
+#
+# cpu_ms is the time spent in this process (building, compiling and binding
+# statements); --no-prepare runs without server-side prepared statements.
+
+CHAT = -1001000000000
+OTHER_CHATS = [-1001000000001, -1001000000002]
+END = datetime.datetime(2020, 1, 1)
+DOMAINS = [
+    'https://open.spotify.com/track/{}',
+    'https://www.youtube.com/watch?v={}',
+    'https://youtu.be/{}',
+    'https://www.deezer.com/track/{}',
+    'https://itunes.apple.com/album/{}',
+    'https://play.google.com/music/{}',
+    'https://soundcloud.com/artist/{}',
+    'https://bandcamp.com/{}',
+]
+
+
+class Dataset(object):
+    """Synthetic users, chats, messages, hashtags and exclusions for one scale."""
+
+    def __init__(self, messages, seed=0):
+        self.random = random.Random(seed)
+        self.messages = messages
+        self.users = max(20, min(2000, messages // 200))
+        self.tags = [f'#tag{i}' for i in range(max(50, int(messages ** 0.5) * 2))]
+
+    def _tag(self):
+        # a few tags are used a lot, most of them rarely
+        return self.tags[min(len(self.tags) - 1, int(self.random.paretovariate(1.2)) - 1)]
+
+    def _user(self):
+        return 1 + min(self.users - 1, int(self.random.expovariate(8 / self.users)))
+
+    def rows(self):
+        r = self.random
+        users = [(i, f'User{i}', None, f'user{i}', False) for i in range(1, self.users + 1)]
+        chats = [(c, 'supergroup') for c in [CHAT] + OTHER_CHATS]
+        messages, hashtags = [], []
+        span = datetime.timedelta(days=730).total_seconds()
+
+        with_links = {c: [] for c, _ in chats}
+        for i in range(1, self.messages + 1):
+            chat = CHAT if r.random() < 0.8 else r.choice(OTHER_CHATS)
+            date = END - datetime.timedelta(seconds=span * (1 - i / self.messages))
+            linked = None
+            if with_links[chat] and r.random() < 0.2:
+                # a tag-only reply to an earlier message with links
+                linked = r.choice(with_links[chat][-1000:])
+                urls = []
+            else:
+                urls = [r.choice(DOMAINS).format(r.getrandbits(48)) for _ in range(r.choice((1, 1, 1, 2, 3)))]
+                with_links[chat].append(i)
+            messages.append((i, i, self._user(), date, chat, urls, len(urls), f'message {i} ' * r.randint(1, 30)))
+
+            for tag in {self._tag() for _ in range(r.choice((0, 1, 1, 2, 3)))}:
+                hashtags.append((len(hashtags) + 1, chat, i, linked, tag))
+
+        exclusions = [(CHAT, self._user(), self._tag()) for _ in range(5)]
+        return users, chats, messages, hashtags, exclusions
+
+
+def _copy(conn, table, columns, rows):
+    def value(v):
+        if v is None:
+            return ''
+        if isinstance(v, list):
+            return '{' + ','.join('"' + u.replace('"', '\\"') + '"' for u in v) + '}'
+        return v
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([value(v) for v in row])
+    buffer.seek(0)
+
+    cursor = conn.cursor()
+    cursor.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def load(d, dataset):
+    users, chats, messages, hashtags, exclusions = dataset.rows()
+
+    d.engine.execute(text('TRUNCATE users, chats, messages, hashtags, users2hashtags RESTART IDENTITY CASCADE'))
+
+    conn = d.engine.raw_connection()
+    try:
+        _copy(conn, 'users', ['id', 'first_name', 'last_name', 'username', 'is_bot'], users)
+        _copy(conn, 'chats', ['id', 'type'], chats)
+        _copy(conn, 'messages', ['id', 'message_id', '"from"', 'date', 'chat', 'urls', 'links', 'text'], messages)
+        _copy(conn, 'hashtags', ['id', 'chat', 'message', 'linked_message', 'hashtag'], hashtags)
+        _copy(conn, 'users2hashtags', ['chat', '"user"', 'hashtag'], set(exclusions))
+        conn.commit()
+    finally:
+        conn.close()
+
+    with d.engine.begin() as conn:
+        conn.execute(text('''
+            SELECT setval('messages_id_seq', (SELECT max(id) FROM messages));
+            SELECT setval('hashtags_id_seq', (SELECT max(id) FROM hashtags));
+
+            INSERT INTO chat_hashtags (chat, hashtag)
+            SELECT DISTINCT h.chat, h.hashtag
+            FROM hashtags h;
+
+            ANALYZE;
+        '''))
+        db.rebuild_sketches(conn)
+        db.roll_up_sketches(conn)
+
+
+def queries(d):
+    """Every report method of DB with arguments typical for the loaded chat."""
+    tag = d.engine.execute(text('''
+        SELECT h.hashtag FROM hashtags h GROUP BY h.hashtag ORDER BY count(*) DESC LIMIT 1
+    ''')).scalar()
+    user = d.engine.execute(text('''
+        SELECT m."from" FROM messages m WHERE m.chat = :chat GROUP BY m."from" ORDER BY count(*) DESC LIMIT 1
+    '''), chat=CHAT).scalar()
+    week = (END - datetime.timedelta(days=7), END)
+
+    return {
+        'links_by_tag': lambda: d.links_by_tag(tag, CHAT),
+        'author_of_tag': lambda: d.author_of_tag(tag, CHAT),
+        'contributor_of_tag': lambda: d.contributor_of_tag(tag, CHAT),
+        'tags_by_author': lambda: d.tags_by_author(user, CHAT),
+        'links_by_author': lambda: d.links_by_author(user, CHAT),
+        'tagged_foreign_by_author': lambda: d.tagged_foreign_by_author(user, CHAT),
+        'all_tags': lambda: d.all_tags(CHAT),
+        'tags_page': lambda: d.tags_page(CHAT),
+        'top_tags': lambda: d.top_tags(CHAT),
+        'top_contributors': lambda: d.top_contributors(CHAT),
+        'top_contributors_by_date': lambda: d.top_contributors_by_date(CHAT, *week),
+        'bottom_contributers': lambda: d.bottom_contributers(CHAT),
+        'top_music_services': lambda: d.top_music_services(CHAT),
+        'unique_contributors': lambda: d.unique_contributors(tag, CHAT),
+        'unique_counts': lambda: d.unique_counts(CHAT),
+    }
+
+
+def ingestion(d):
+    """The writes of one incoming message, as the bot does them."""
+    message_ids = itertools.count(10 ** 9)
+    tags = [t for t, in d.engine.execute(text('''
+        SELECT h.hashtag FROM hashtags h GROUP BY h.hashtag ORDER BY count(*) DESC LIMIT 3
+    '''))]
+
+    def add_message():
+        date = END - datetime.timedelta(minutes=1)
+        urls = [DOMAINS[0].format(next(message_ids))]
+        m_id = d.add_message(next(message_ids), 1, date, CHAT, urls, 'message').first()[0]
+        d.add_hashtags([d.make_hashtag(m_id, CHAT, t) for t in tags])
+        d.add_chat_hashtags(CHAT, tags)
+        d.update_sketches(CHAT, date, 1, tags, urls)
+
+    return {
+        'add_user': lambda: d.add_user(1, 'User1', username='user1', overwrite=True),
+        'add_chat': lambda: d.add_chat(CHAT, 'supergroup'),
+        'add_message': add_message,
+    }
+
+
+def _fetch(fn):
+    result = fn()
+    # the sketch based methods and the writes return plain values instead of rows
+    return result.fetchall() if hasattr(result, 'fetchall') and result.returns_rows else [result]
+
+
+def measure(fn, repeat):
+    _fetch(fn)  # warm up caches
+    timings, cpu = [], []
+    for _ in range(repeat):
+        started, cpu_started = time.perf_counter(), time.process_time()
+        rows = _fetch(fn)
+        timings.append((time.perf_counter() - started) * 1000)
+        cpu.append((time.process_time() - cpu_started) * 1000)
+
+    timings.sort()
+    return {
+        'rows': len(rows),
+        'min_ms': timings[0],
+        'median_ms': statistics.median(timings),
+        'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        'mean_ms': statistics.mean(timings),
+        'cpu_ms': statistics.median(cpu),
+    }
+
+
+def run(d, scales, repeat, seed, only=None):
+    results = {}
+    for scale in scales:
+        started = time.perf_counter()
+        load(d, Dataset(scale, seed))
+        print(f'Loaded {scale} messages in {time.perf_counter() - started:.1f} s', file=sys.stderr)
+
+        results[str(scale)] = {}
+        for name, fn in {**queries(d), **ingestion(d)}.items():
+            if only and name not in only:
+                continue
+            results[str(scale)][name] = r = measure(fn, repeat)
+            print(
+                f'{scale:>9} {name:<26} {r["median_ms"]:>10.2f} ms {r["cpu_ms"]:>8.2f} cpu ms  ({r["rows"]} rows)',
+                file=sys.stderr
+            )
+
+    return results
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)['results']
+    with open(new_path) as f:
+        new = json.load(f)['results']
+
+    print(f'{"scale":>9} {"query":<26} {"old ms":>10} {"new ms":>10} {"ratio":>7} {"old cpu":>9} {"new cpu":>9}')
+    for scale, methods in new.items():
+        for name, r in methods.items():
+            before = old.get(scale, {}).get(name)
+            if before is None:
+                continue
+            ratio = r['median_ms'] / before['median_ms'] if before['median_ms'] else float('inf')
+            # cpu_ms is missing from reports written before it was measured
+            cpu = ''.join(f' {c:>9.2f}' if c is not None else f' {"-":>9}' for c in (before.get('cpu_ms'), r.get('cpu_ms')))
+            print(f'{scale:>9} {name:<26} {before["median_ms"]:>10.2f} {r["median_ms"]:>10.2f} {ratio:>6.2f}x{cpu}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the DB report queries and ingestion')
+    parser.add_argument('--scales', default='10000,100000', help='comma-separated message counts')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', help='comma-separated query names')
+    parser.add_argument('--no-prepare', action='store_true', help='without server-side prepared statements')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two JSON reports')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    d = db.DB(full_uri=os.environ['BENCH_DATABASE_URL'], prepare=not args.no_prepare)
+    migrations.migrate(d.engine)
+
+    scales = [int(s) for s in args.scales.split(',')]
+    only = set(args.only.split(',')) if args.only else None
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+
+    report = {
+        'meta': {
+            'commit': commit,
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'postgres': d.engine.execute(text('SHOW server_version')).scalar(),
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'prepare': not args.no_prepare,
+        },
+        'results': run(d, scales, args.repeat, args.seed, only),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
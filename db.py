@@ -1,16 +1,80 @@
-from sqlalchemy import create_engine, select, text
+import datetime
+import functools
+import hashlib
+import logging
+import re
+import threading
+import time
+import zlib
+
+from sqlalchemy import create_engine, func, select, text
 from sqlalchemy import \
     BigInteger,        \
     Boolean,           \
     Column,            \
+    Date,              \
     DateTime,          \
     ForeignKey,        \
+    ForeignKeyConstraint, \
+    Index,             \
     Integer,           \
+    LargeBinary,       \
     MetaData,          \
     String,            \
     Table,             \
     UniqueConstraint
 from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Engine
+
+import hll
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# a bind parameter of a text() query, e.g. `:chat_id` but not `::int`
+_BIND = re.compile(r'(?<![:\w\\]):(\w+)(?!:)')
+
+
+class _Statement(object):
+    """A query with :binds, prepared on the server once per connection
+    (`PREPARE name AS ... $1 ...`) and then run with `EXECUTE name(:p1, ...)`."""
+
+    def __init__(self, sql):
+        params = []
+
+        def number(m):
+            if m.group(1) not in params:
+                params.append(m.group(1))
+            return f'${params.index(m.group(1)) + 1}'
+
+        self.name = 'hs_' + hashlib.sha1(sql.encode()).hexdigest()[:16]
+        self.text = text(sql)
+        self.prepare = text(f'PREPARE {self.name} AS {_BIND.sub(number, sql)}')
+        # with the legacy autocommit, EXECUTE of a write must be committed too
+        writes = re.match(r'\s*(INSERT|UPDATE|DELETE)\b', sql, re.IGNORECASE) is not None
+        args = '(' + ', '.join(f':{p}' for p in params) + ')' if params else ''
+        self.execute = text(f'EXECUTE {self.name}{args}').execution_options(autocommit=writes)
+
+
+def _compiled_sql(construct, keys):
+    """SQL of a Core statement for the given parameter names, with :binds."""
+    # for_executemany: no implicit RETURNING of the primary key, only an explicit one
+    sql = str(construct.compile(dialect=postgresql.dialect(), column_keys=list(keys), for_executemany=True))
+    # parenthesized, as some are followed by a cast, e.g. `%(urls)s::VARCHAR(4096)[]`
+    return re.sub(r'%\((\w+)\)s', r'(:\1)', sql).replace('%%', '%')
+
+
+def _built_once(method):
+    # statement constructs don't depend on anything but the arguments
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        key = (method.__name__, *args)
+        construct = self._constructs.get(key)
+        if construct is None:
+            construct = self._constructs[key] = method(self, *args)
+        return construct
+
+    return wrapper
 
 
 class DB(object):
@@ -40,27 +104,50 @@ class DB(object):
     )
 
     text_type = String(4096)
+
+    # messages and hashtags are hash-partitioned by chat (see migrations.py), so
+    # every query should filter them on chat for the other partitions to be pruned
     messages = Table(
         'messages', meta,
         Column('id', Integer, primary_key=True, autoincrement=True),
         Column('message_id', Integer, nullable=False),
         Column('from', ForeignKey(users.c.id), nullable=False),
         Column('date', DateTime, nullable=False),
-        Column('chat', ForeignKey(chats.c.id), nullable=False),
+        Column('chat', ForeignKey(chats.c.id), primary_key=True),
+        Column('urls', postgresql.ARRAY(text_type)),
+        Column('links', Integer, nullable=False, server_default='0'),
+        Column('text', text_type),
+        UniqueConstraint('message_id', 'chat'),
+        postgresql_partition_by='HASH (chat)'
+    )
+
+    # text and urls of old messages, moved out of the hot table by archive_messages();
+    # text_z is the zlib-compressed text when archived with compression
+    messages_archive = Table(
+        'messages_archive', meta,
+        Column('message', Integer, primary_key=True),
+        Column('chat', BigInteger, nullable=False),
+        Column('archived', DateTime, nullable=False, server_default=func.now()),
         Column('urls', postgresql.ARRAY(text_type)),
         Column('text', text_type),
-        UniqueConstraint('message_id', 'chat')
+        Column('text_z', LargeBinary),
+        ForeignKeyConstraint(['message', 'chat'], [messages.c.id, messages.c.chat], ondelete='CASCADE')
     )
 
     hashtag_type = String(255)
 
+    # a tag-only reply links the message with the urls, always from the same chat
     hashtags = Table(
         'hashtags', meta,
         Column('id', Integer, primary_key=True, autoincrement=True),
-        Column('message', ForeignKey(messages.c.id), nullable=False),
-        Column('linked_message', ForeignKey(messages.c.id)),
+        Column('chat', BigInteger, primary_key=True),
+        Column('message', Integer, nullable=False),
+        Column('linked_message', Integer),
         Column('hashtag', hashtag_type, nullable=False),
-        UniqueConstraint('message', 'hashtag')
+        UniqueConstraint('message', 'hashtag', 'chat'),
+        ForeignKeyConstraint(['message', 'chat'], [messages.c.id, messages.c.chat]),
+        ForeignKeyConstraint(['linked_message', 'chat'], [messages.c.id, messages.c.chat]),
+        postgresql_partition_by='HASH (chat)'
     )
 
     users2hashtags = Table(
@@ -70,17 +157,155 @@ class DB(object):
         Column('hashtag', hashtag_type, primary_key=True)
     )
 
-    def __init__(self, user='', password='', db='', host='localhost', port=5432, *, full_uri='', echo=False):
-        if full_uri:
-            self.engine = create_engine(full_uri, echo=echo)
-        else:
-            self.engine = create_engine(
-                f'postgresql://{user}:{password}@{host}:{port}/{db}',
-                echo=echo
-            )
+    # distinct tags of every chat, for cheap keyset-paginated listings
+    chat_hashtags = Table(
+        'chat_hashtags', meta,
+        Column('chat', ForeignKey(chats.c.id), primary_key=True),
+        Column('hashtag', hashtag_type, primary_key=True)
+    )
 
-    def create_all(self):
-        self.meta.create_all(self.engine)
+    # HyperLogLog sketches (see hll.py) of distinct values, kept up to date at ingest
+    tag_sketches = Table(
+        'tag_sketches', meta,
+        Column('chat', ForeignKey(chats.c.id), primary_key=True),
+        Column('hashtag', hashtag_type, primary_key=True),
+        Column('contributors', LargeBinary, nullable=False)
+    )
+
+    day_sketches = Table(
+        'day_sketches', meta,
+        Column('chat', ForeignKey(chats.c.id), primary_key=True),
+        Column('day', Date, primary_key=True),
+        Column('tags', LargeBinary, nullable=False),
+        Column('links', LargeBinary, nullable=False),
+        Column('contributors', LargeBinary, nullable=False)
+    )
+
+    # unions of the day sketches of a month or a year, so that a long range
+    # merges a few dozen sketches instead of one per day
+    period_sketches = Table(
+        'period_sketches', meta,
+        Column('chat', ForeignKey(chats.c.id), primary_key=True),
+        Column('period', String(5), primary_key=True),  # 'month' or 'year'
+        Column('start', Date, primary_key=True),
+        Column('tags', LargeBinary, nullable=False),
+        Column('links', LargeBinary, nullable=False),
+        Column('contributors', LargeBinary, nullable=False)
+    )
+
+    updates = Table(
+        'updates', meta,
+        Column('update_id', BigInteger, primary_key=True, autoincrement=False),
+        Column('chat', BigInteger),
+        Column('payload', postgresql.JSONB, nullable=False),
+        Column('received', DateTime, nullable=False, server_default=func.now()),
+        Column('processed', DateTime)
+    )
+    Index('updates_pending', updates.c.update_id, postgresql_where=updates.c.processed.is_(None))
+
+    def __init__(self, user='', password='', db='', host='localhost', port=5432, *,
+                 full_uri='', replica_uri='', max_staleness=5.0, echo=False, prepare=True):
+        self.uri = full_uri or f'postgresql://{user}:{password}@{host}:{port}/{db}'
+        self.replica_uri = replica_uri
+        self.max_staleness = max_staleness
+        self.echo = echo
+        # server-side prepared statements don't work behind a transaction-pooling pgbouncer
+        self.prepare = prepare
+        self._engine = None
+        self._replica_engine = None
+        self._engine_lock = threading.Lock()
+        self._replica_lag = (float('-inf'), 0.0)
+        self._last_writes = {}
+        self._exclusions = {}
+        self._constructs = {}
+        self._statements = {}
+
+    @property
+    def engine(self):
+        # created on first use, so importing and constructing DB stays cheap
+        if self._engine is None:
+            with self._engine_lock:
+                if self._engine is None:
+                    self._engine = create_engine(self.uri, echo=self.echo)
+        return self._engine
+
+    @property
+    def replica_engine(self):
+        if self._replica_engine is None:
+            with self._engine_lock:
+                if self._replica_engine is None:
+                    self._replica_engine = create_engine(self.replica_uri, echo=self.echo)
+        return self._replica_engine
+
+    def replica_lag(self):
+        checked, lag = self._replica_lag
+        now = time.monotonic()
+        if now - checked < 1.0:
+            return lag
+
+        try:
+            lag = self.replica_engine.execute(text('''
+                SELECT CASE
+                    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+                END
+            ''')).scalar()
+        except Exception:
+            logger.warning('Replica is unavailable', exc_info=True)
+            lag = float('inf')
+
+        self._replica_lag = (now, float(lag))
+        metrics.gauge('db.replica.lag', float(lag))
+        return float(lag)
+
+    def _reader(self, chat_id):
+        """Engine for a read-only report: the replica unless it may miss recent data."""
+        if not self.replica_uri:
+            return self.engine
+
+        if time.monotonic() - self._last_writes.get(chat_id, float('-inf')) < self.max_staleness:
+            # read-your-writes: the chat has just ingested something
+            metrics.inc('db.route.primary.own_write')
+            return self.engine
+
+        if self.replica_lag() > self.max_staleness:
+            metrics.inc('db.route.primary.stale')
+            return self.engine
+
+        metrics.inc('db.route.replica')
+        return self.replica_engine
+
+    def _statement(self, query, keys):
+        statement = self._statements.get((query, keys))
+        if statement is None:
+            sql = query if isinstance(query, str) else _compiled_sql(query, keys)
+            statement = self._statements[(query, keys)] = _Statement(sql)
+        return statement
+
+    def _execute(self, bind, query, params=None, *, prepared=True, **kwargs):
+        """Runs `query` (SQL with :binds, or a Core statement from one of the
+        _insert_* methods) on an engine or a connection as a prepared statement,
+        with kwargs or with a list of parameters for each row.
+
+        After a few runs Postgres may switch a prepared statement to a generic
+        plan, the same for all parameters: queries whose best plan depends on
+        the values (e.g. a popular tag vs a rare one) pass prepared=False."""
+        params = params if params is not None else kwargs
+        if isinstance(bind, Engine):
+            with bind.connect() as conn:
+                return self._execute(conn, query, params, prepared=prepared)
+
+        first = params[0] if isinstance(params, list) else params
+        statement = self._statement(query, () if isinstance(query, str) else tuple(first))
+        if not (self.prepare and prepared):
+            return bind.execute(statement.text, params)
+
+        # the names prepared on the DBAPI connection, gone with it
+        names = bind.info.setdefault('prepared', set())
+        if statement.name not in names:
+            bind.execute(statement.prepare)
+            names.add(statement.name)
+        return bind.execute(statement.execute, params)
 
     def make_user(self, id, first_name, last_name=None, username=None, is_bot=False):
         return {
@@ -91,6 +316,7 @@ class DB(object):
             'is_bot': is_bot
         }
 
+    @_built_once
     def _insert_user(self, upsert=False):
         ins = postgresql.insert(self.users)
         if upsert:
@@ -111,7 +337,7 @@ class DB(object):
             return ins.on_conflict_do_nothing()
 
     def add_user(self, id, first_name, last_name=None, username=None, is_bot=False, *, overwrite=False):
-        return self.engine.execute(self._insert_user(overwrite), **self.make_user(
+        return self._execute(self.engine, self._insert_user(overwrite), **self.make_user(
             id,
             first_name,
             last_name,
@@ -123,19 +349,27 @@ class DB(object):
         if len(users) == 0:
             return None
 
-        return self.engine.execute(self._insert_user(overwrite), users)
+        return self._execute(self.engine, self._insert_user(overwrite), users)
 
     def find_user(self, username):
         return self.engine.execute(
             select([self.users.c.id]).where(self.users.c.username == username)
         )
 
+    def users_by_id(self, ids):
+        return self._execute(self.engine, '''
+            SELECT u.id, u.first_name, u.last_name, u.username
+            FROM users u
+            WHERE u.id = ANY(:ids)
+        ''', ids=list(ids))
+
     def make_chat(self, id, type_):
         return {
             'id': id,
             'type': type_
         }
 
+    @_built_once
     def _insert_chat(self, upsert=False):
         ins = postgresql.insert(self.chats)
         if upsert:
@@ -147,7 +381,7 @@ class DB(object):
             return ins.on_conflict_do_nothing()
 
     def add_chat(self, id, type_, *, overwrite=False):
-        return self.engine.execute(self._insert_chat(overwrite), **self.make_chat(
+        return self._execute(self.engine, self._insert_chat(overwrite), **self.make_chat(
             id, type_
         ))
 
@@ -155,7 +389,7 @@ class DB(object):
         if len(chats) == 0:
             return None
 
-        return self.engine.execute(self._insert_chat(overwrite), chats)
+        return self._execute(self.engine, self._insert_chat(overwrite), chats)
 
     def make_message(self, message_id, from_, date, chat, urls=[], text=''):
         return {
@@ -164,23 +398,22 @@ class DB(object):
             'date': date,
             'chat': chat,
             'urls': urls,
+            'links': len(urls),
             'text': text
         }
 
-    def _insert_message(self, upsert=False):
+    @_built_once
+    def _insert_message(self, upsert=False, returning=False):
         ins = postgresql.insert(self.messages)
+        if returning:
+            ins = ins.returning(self.messages.c.id)
         if upsert:
-            new_message = self.make_message(
-                ins.excluded.message_id,
-                ins.excluded['from'],
-                ins.excluded.date,
-                ins.excluded.chat,
-                ins.excluded.urls,
-                ins.excluded.text
-            )
-            del new_message['message_id']
-            del new_message['from']
-            del new_message['chat']
+            new_message = {
+                'date': ins.excluded.date,
+                'urls': ins.excluded.urls,
+                'links': ins.excluded.links,
+                'text': ins.excluded.text
+            }
             return ins.on_conflict_do_update(
                 index_elements=[self.messages.c.message_id, self.messages.c.chat],
                 set_=new_message
@@ -189,49 +422,69 @@ class DB(object):
             return ins.on_conflict_do_nothing()
 
     def add_message(self, message_id, from_, date, chat, urls=[], text='', *, overwrite=False):
-        ins = self._insert_message(overwrite).returning(self.messages.c.id)
-        return self.engine.execute(ins, **self.make_message(
-            message_id,
-            from_,
-            date,
-            chat,
-            urls,
-            text
-        ))
+        with self.engine.begin() as conn:
+            inserted = self._execute(conn, self._insert_message(overwrite, True), **self.make_message(
+                message_id,
+                from_,
+                date,
+                chat,
+                urls,
+                text
+            ))
+            if overwrite:
+                # an edit brings an archived message back into the hot table;
+                # in the same transaction, so archive_messages() can't interleave
+                self._execute(conn, '''
+                    DELETE FROM messages_archive
+                    WHERE chat = :chat
+                      AND message = (
+                        SELECT m.id
+                        FROM messages m
+                        WHERE m.message_id = :message_id
+                          AND m.chat = :chat
+                      )
+                ''', message_id=message_id, chat=chat)
+        self._last_writes[chat] = time.monotonic()
+        return inserted
 
     def add_messages(self, messages, *, overwrite=False):
         if len(messages) == 0:
             return None
 
-        return self.engine.execute(self._insert_message(overwrite), messages)
+        return self._execute(self.engine, self._insert_message(overwrite), messages)
 
-    def find_message(self, id):
-        return self.engine.execute(
-            select([self.messages.c.id]).where(self.messages.c.message_id == id)
-        )
+    def find_message(self, id, chat):
+        return self._execute(self.engine, '''
+            SELECT m.id
+            FROM messages m
+            WHERE m.message_id = :message_id
+              AND m.chat = :chat
+        ''', message_id=id, chat=chat)
 
-    def make_hashtag(self, message, hashtag, linked_message=None):
+    def make_hashtag(self, message, chat, hashtag, linked_message=None):
         return {
             'message': message,
+            'chat': chat,
             'hashtag': hashtag,
             'linked_message': linked_message
         }
 
+    @_built_once
     def _insert_hashtag(self, upsert=False):
         ins = postgresql.insert(self.hashtags)
         if upsert:
-            return ins.on_conflict_do_update(
-                constraint=self.hashtags.primary_key,
-                set_={'hashtag': ins.excluded.hashtag}
-            ).on_conflict_do_nothing(
-                index_elements=[self.hashtags.c.message, self.hashtags.c.hashtag]
+            # an edit can only clash on (message, hashtag); SQLAlchemy 1.4
+            # rejects a second ON CONFLICT clause on the same insert
+            return ins.on_conflict_do_nothing(
+                index_elements=[self.hashtags.c.message, self.hashtags.c.hashtag, self.hashtags.c.chat]
             )
         else:
             return ins.on_conflict_do_nothing()
 
-    def add_hashtag(self, message, hashtag, linked_message=None, *, overwrite=False):
-        return self.engine.execute(self._insert_hashtag(overwrite), **self.make_hashtag(
+    def add_hashtag(self, message, chat, hashtag, linked_message=None, *, overwrite=False):
+        return self._execute(self.engine, self._insert_hashtag(overwrite), **self.make_hashtag(
             message,
+            chat,
             hashtag,
             linked_message
         ))
@@ -240,123 +493,189 @@ class DB(object):
         if len(hashtags) == 0:
             return None
 
-        return self.engine.execute(self._insert_hashtag(overwrite), hashtags)
+        return self._execute(self.engine, self._insert_hashtag(overwrite), hashtags)
+
+    def add_chat_hashtags(self, chat, hashtags):
+        if len(hashtags) == 0:
+            return None
+
+        return self._execute(self.engine, self._insert_chat_hashtag(), [
+            {'chat': chat, 'hashtag': h} for h in hashtags
+        ])
+
+    @_built_once
+    def _insert_chat_hashtag(self):
+        return postgresql.insert(self.chat_hashtags).on_conflict_do_nothing()
+
+    def chat_tags(self, chat_id):
+        return self.engine.execute(
+            select([self.chat_hashtags.c.hashtag]).where(self.chat_hashtags.c.chat == chat_id)
+        )
+
+    def excluded_tags(self, chat_id):
+        """Personal tags of the chat, left out of the tag reports. Cached per chat."""
+        excluded = self._exclusions.get(chat_id)
+        if excluded is None:
+            excluded = frozenset(
+                r['hashtag'] for r in self.engine.execute(text('''
+                    SELECT DISTINCT u2h.hashtag
+                    FROM users2hashtags u2h
+                    WHERE u2h.chat = :chat_id
+                '''), chat_id=chat_id)
+            )
+            self._exclusions[chat_id] = excluded
+        return excluded
+
+    def _excluded(self, chat_id):
+        # bound as a literal array, e.g. `h.hashtag <> ALL(:excluded)`
+        return sorted(self.excluded_tags(chat_id))
+
+    def exclude_tag(self, chat_id, user_id, hashtag):
+        res = self.engine.execute(postgresql.insert(self.users2hashtags).on_conflict_do_nothing(), {
+            'chat': chat_id,
+            'user': user_id,
+            'hashtag': hashtag
+        })
+        self._exclusions.pop(chat_id, None)
+        return res
+
+    def include_tag(self, chat_id, hashtag):
+        res = self.engine.execute(
+            self.users2hashtags.delete()
+                .where(self.users2hashtags.c.chat == chat_id)
+                .where(self.users2hashtags.c.hashtag == hashtag)
+        )
+        self._exclusions.pop(chat_id, None)
+        return res
 
     def links_by_tag(self, hashtag, chat_id):
-        return self.engine.execute(text('''
-            SELECT h.hashtag, sum(array_length(m.urls, 1)) as links
+        return self._execute(self._reader(chat_id), '''
+            SELECT h.hashtag, sum(nullif(m.links, 0)) as links
             FROM hashtags h
-                INNER JOIN messages m ON h.message = m.id OR h.linked_message = m.id
+                INNER JOIN messages m ON (h.message = m.id OR h.linked_message = m.id) AND h.chat = m.chat
                 INNER JOIN chats c on m.chat = c.id
             WHERE h.hashtag = :tag
             AND c.id = :chat_id
             GROUP BY h.hashtag
             ORDER BY links DESC
-        '''), tag=hashtag, chat_id=chat_id)
+        ''', tag=hashtag, chat_id=chat_id, prepared=False)
 
     def author_of_tag(self, hashtag, chat_id):
-        return self.engine.execute(text('''
-            SELECT h.hashtag, u.id, u.first_name, u.last_name, u.username, m.text, m.date
+        return self._execute(self._reader(chat_id), '''
+            SELECT h.hashtag, u.id, u.first_name, u.last_name, u.username, m.date
             FROM hashtags h
-                INNER JOIN messages m ON h.message = m.id
+                INNER JOIN messages m ON h.message = m.id AND h.chat = m.chat
                 INNER JOIN users u on m."from" = u.id
                 INNER JOIN (
                     SELECT h.hashtag, min(m.date) as first_date
                     FROM hashtags h
-                        INNER JOIN messages m ON h.message = m.id
+                        INNER JOIN messages m ON h.message = m.id AND h.chat = m.chat
                         INNER JOIN chats c on m.chat = c.id
                     WHERE h.hashtag = :tag
                       AND c.id = :chat_id
                     GROUP BY h.hashtag
                 ) hh ON h.hashtag = hh.hashtag AND m.date = hh.first_date
-        '''), tag=hashtag, chat_id=chat_id)
+            WHERE m.chat = :chat_id
+        ''', tag=hashtag, chat_id=chat_id, prepared=False)
 
     def contributor_of_tag(self, hashtag, chat_id):
-        return self.engine.execute(text('''
+        return self._execute(self._reader(chat_id), '''
             SELECT h.hashtag, u.id, u.first_name, u.last_name, u.username, count(h.message) as count
             FROM hashtags h
-                INNER JOIN messages m ON h.message = m.id
+                INNER JOIN messages m ON h.message = m.id AND h.chat = m.chat
                 INNER JOIN users u ON m."from" = u.id
                 INNER JOIN chats c on m.chat = c.id
             WHERE h.hashtag = :tag
             AND c.id = :chat_id
             GROUP BY h.hashtag, u.id, u.first_name, u.last_name, u.username
             ORDER BY count DESC
-        '''), tag=hashtag, chat_id=chat_id)
+        ''', tag=hashtag, chat_id=chat_id, prepared=False)
 
     def tags_by_author(self, user_id, chat_id):
-        return self.engine.execute(text('''
+        return self._execute(self._reader(chat_id), '''
             SELECT u.id, u.first_name, u.last_name, u.username, count(h.hashtag) AS count, array_agg(h.hashtag) AS tags
             FROM hashtags h
-                INNER JOIN messages m ON h.message = m.id
+                INNER JOIN messages m ON h.message = m.id AND h.chat = m.chat
                 INNER JOIN users u ON m."from" = u.id
                 INNER JOIN (
                     SELECT h.hashtag, min(m.date) as first_date
                     FROM hashtags h
-                        INNER JOIN messages m ON h.message = m.id
+                        INNER JOIN messages m ON h.message = m.id AND h.chat = m.chat
                         INNER JOIN chats c on m.chat = c.id
                     WHERE c.id = :chat_id
                     GROUP BY h.hashtag
                 ) hh ON h.hashtag = hh.hashtag AND m.date = hh.first_date
             WHERE u.id = :user_id
+              AND m.chat = :chat_id
             GROUP BY u.id, u.first_name, u.last_name, u.username
             ORDER BY count DESC
-        '''), user_id=user_id, chat_id=chat_id)
+        ''', user_id=user_id, chat_id=chat_id)
 
     def links_by_author(self, user_id, chat_id):
-        return self.engine.execute(text('''
-            SELECT u.id, u.first_name, u.last_name, u.username, sum(array_length(m.urls, 1))
+        return self._execute(self._reader(chat_id), '''
+            SELECT u.id, u.first_name, u.last_name, u.username, sum(nullif(m.links, 0))
             FROM users u
                 INNER JOIN messages m on u.id = m."from"
                 INNER JOIN chats c on m.chat = c.id
             WHERE u.id = :user_id
                 AND c.id = :chat_id
             GROUP BY u.id, u.first_name, u.last_name, u.username
-        '''), user_id=user_id, chat_id=chat_id)
+        ''', user_id=user_id, chat_id=chat_id)
 
     def tagged_foreign_by_author(self, user_id, chat_id):
-        return self.engine.execute(text('''
+        return self._execute(self._reader(chat_id), '''
             SELECT h.hashtag, m.id AS tagged_message, u.id AS tagger, m2.id AS message_with_link, u2.id AS reply_to
             FROM hashtags h
-                INNER JOIN messages m on h.message = m.id
+                INNER JOIN messages m on h.message = m.id AND h.chat = m.chat
                 INNER JOIN chats c on m.chat = c.id
                 INNER JOIN users u on m."from" = u.id
-                INNER JOIN messages m2 ON h.linked_message = m2.id
+                INNER JOIN messages m2 ON h.linked_message = m2.id AND h.chat = m2.chat
                 INNER JOIN users u2 ON m2."from" = u2.id
             WHERE u.id <> u2.id
             AND u.id = :user_id
             AND c.id = :chat_id
-        '''), user_id=user_id, chat_id=chat_id)
+        ''', user_id=user_id, chat_id=chat_id)
 
     def all_tags(self, chat_id):
-        return self.engine.execute(text('''
+        return self._execute(self._reader(chat_id), '''
             SELECT DISTINCT h.hashtag
             FROM hashtags h
-                INNER JOIN messages m ON m.id = h.message
+                INNER JOIN messages m ON m.id = h.message AND m.chat = h.chat
                 INNER JOIN chats c ON c.id = m.chat
-                LEFT JOIN users2hashtags u2h on h.hashtag = u2h.hashtag
-            WHERE u2h.hashtag IS NULL
+            WHERE h.hashtag <> ALL(:excluded)
             AND c.id = :chat_id
             ORDER BY h.hashtag
-        '''), chat_id=chat_id)
+        ''', chat_id=chat_id, excluded=self._excluded(chat_id))
+
+    def tags_page(self, chat_id, after='', limit=100, *, inclusive=False):
+        """Tags of the chat in order, starting right after (or at) `after`."""
+        op = '>=' if inclusive else '>'
+        return self._execute(self._reader(chat_id), f'''
+            SELECT ch.hashtag
+            FROM chat_hashtags ch
+            WHERE ch.chat = :chat_id
+              AND ch.hashtag {op} :after
+              AND ch.hashtag <> ALL(:excluded)
+            ORDER BY ch.hashtag
+            LIMIT :limit
+        ''', chat_id=chat_id, after=after, limit=limit, excluded=self._excluded(chat_id))
 
     def top_tags(self, chat_id, limit=10):
-        return self.engine.execute(text('''
-            SELECT h.hashtag, sum(array_length(m.urls, 1)) as links
+        return self._execute(self._reader(chat_id), '''
+            SELECT h.hashtag, sum(nullif(m.links, 0)) as links
             FROM hashtags h
-                INNER JOIN messages m ON h.message = m.id OR h.linked_message = m.id
+                INNER JOIN messages m ON (h.message = m.id OR h.linked_message = m.id) AND h.chat = m.chat
                 INNER JOIN chats c ON m.chat = c.id
-                LEFT JOIN users2hashtags u2h ON h.hashtag = u2h.hashtag
-            WHERE u2h IS NULL
+            WHERE h.hashtag <> ALL(:excluded)
               AND c.id = :chat_id
             GROUP BY h.hashtag
             ORDER BY links DESC, hashtag ASC
             LIMIT :limit
-        '''), chat_id=chat_id, limit=limit)
+        ''', chat_id=chat_id, limit=limit, excluded=self._excluded(chat_id))
 
     def top_contributors(self, chat_id, limit=5):
-        return self.engine.execute(text('''
-            SELECT u.id, u.first_name, u.last_name, u.username, coalesce(sum(array_length(m.urls, 1)), 0) AS sum
+        return self._execute(self._reader(chat_id), '''
+            SELECT u.id, u.first_name, u.last_name, u.username, coalesce(sum(m.links), 0) AS sum
             FROM users u
                 INNER JOIN messages m on u.id = m."from"
                 INNER JOIN chats c on m.chat = c.id
@@ -364,11 +683,11 @@ class DB(object):
             GROUP BY u.id, u.first_name, u.last_name, u.username
             ORDER BY sum DESC
             LIMIT :limit
-        '''), chat_id=chat_id, limit=limit)
+        ''', chat_id=chat_id, limit=limit)
 
     def top_contributors_by_date(self, chat_id, from_, to, limit=5):
-        return self.engine.execute(text('''
-            SELECT u.id, u.first_name, u.last_name, u.username, coalesce(sum(array_length(m.urls, 1)), 0) AS sum
+        return self._execute(self._reader(chat_id), '''
+            SELECT u.id, u.first_name, u.last_name, u.username, coalesce(sum(m.links), 0) AS sum
             FROM users u
                 INNER JOIN messages m on u.id = m."from"
                 INNER JOIN chats c on m.chat = c.id
@@ -377,11 +696,11 @@ class DB(object):
             GROUP BY u.id, u.first_name, u.last_name, u.username
             ORDER BY sum DESC
             LIMIT :limit
-        '''), chat_id=chat_id, from_date=from_, to_date=to, limit=limit)
+        ''', chat_id=chat_id, from_date=from_, to_date=to, limit=limit)
 
     def bottom_contributers(self, chat_id, limit=5):
-        return self.engine.execute(text('''
-            SELECT u.id, u.first_name, u.last_name, u.username, coalesce(sum(array_length(m.urls, 1)), 0) AS sum
+        return self._execute(self._reader(chat_id), '''
+            SELECT u.id, u.first_name, u.last_name, u.username, coalesce(sum(m.links), 0) AS sum
             FROM users u
                 LEFT JOIN messages m ON u.id = m."from"
                 INNER JOIN chats c ON m.chat = c.id
@@ -389,15 +708,19 @@ class DB(object):
             GROUP BY u.id, u.first_name, u.last_name, u.username
             ORDER BY sum ASC
             LIMIT :limit
-        '''), chat_id=chat_id, limit=limit)
+        ''', chat_id=chat_id, limit=limit)
 
     def top_music_services(self, chat_id):
-        return self.engine.execute(text(r'''
+        return self._execute(self._reader(chat_id), r'''
             WITH all_urls AS (
-                SELECT unnest(urls) AS link
+                SELECT unnest(m.urls) AS link
                 FROM messages m
                     INNER JOIN chats c on m.chat = c.id
                 WHERE c.id = :chat_id
+                UNION ALL
+                SELECT unnest(a.urls) AS link
+                FROM messages_archive a
+                WHERE a.chat = :chat_id
             ), categorized_urls AS (
                 SELECT lower(coalesce (
                     substring (m.link FROM '^https://open.(spotify)\.com.+$'),
@@ -413,4 +736,366 @@ class DB(object):
             FROM categorized_urls
             GROUP BY category
             ORDER BY count DESC
-        '''), chat_id=chat_id)
+        ''', chat_id=chat_id)
+
+    @_built_once
+    def _upsert_tag_sketch(self):
+        ins = postgresql.insert(self.tag_sketches)
+        return ins.on_conflict_do_update(
+            constraint=self.tag_sketches.primary_key,
+            set_={'contributors': ins.excluded.contributors}
+        )
+
+    @_built_once
+    def _upsert_day_sketch(self):
+        ins = postgresql.insert(self.day_sketches)
+        return ins.on_conflict_do_update(
+            constraint=self.day_sketches.primary_key,
+            set_={
+                'tags': ins.excluded.tags,
+                'links': ins.excluded.links,
+                'contributors': ins.excluded.contributors
+            }
+        )
+
+    @_built_once
+    def _upsert_period_sketch(self):
+        ins = postgresql.insert(self.period_sketches)
+        return ins.on_conflict_do_update(
+            constraint=self.period_sketches.primary_key,
+            set_={
+                'tags': ins.excluded.tags,
+                'links': ins.excluded.links,
+                'contributors': ins.excluded.contributors
+            }
+        )
+
+    def update_sketches(self, chat, date, user, hashtags, urls):
+        # a read-modify-write: relies on updates of one chat being handled
+        # one at a time (see lanes.py and workqueue.py)
+        with self.engine.begin() as conn:
+            tags = {
+                r['hashtag']: hll.HyperLogLog.from_bytes(r['contributors'])
+                for r in self._execute(conn, '''
+                    SELECT ts.hashtag, ts.contributors
+                    FROM tag_sketches ts
+                    WHERE ts.chat = :chat
+                      AND ts.hashtag = ANY(:tags)
+                    FOR UPDATE
+                ''', chat=chat, tags=list(hashtags))
+            }
+            changed = [
+                {'chat': chat, 'hashtag': t, 'contributors': sketch.to_bytes()}
+                for t, sketch in ((t, tags.get(t, hll.HyperLogLog())) for t in set(hashtags))
+                if sketch.add(user)
+            ]
+            if len(changed) > 0:
+                self._execute(conn, self._upsert_tag_sketch(), changed)
+
+            day = self._execute(conn, '''
+                SELECT ds.tags, ds.links, ds.contributors
+                FROM day_sketches ds
+                WHERE ds.chat = :chat
+                  AND ds.day = :day
+                FOR UPDATE
+            ''', chat=chat, day=date.date()).fetchone()
+            added = _added(day, hashtags, urls, user)
+            if added is not None:
+                self._execute(conn, self._upsert_day_sketch(), dict(added, chat=chat, day=date.date()))
+
+            month, year = date.date().replace(day=1), date.date().replace(month=1, day=1)
+            periods = {
+                (r['period'], r['start']): r
+                for r in self._execute(conn, '''
+                    SELECT ps.period, ps.start, ps.tags, ps.links, ps.contributors
+                    FROM period_sketches ps
+                    WHERE ps.chat = :chat
+                      AND ((ps.period = 'month' AND ps.start = :month) OR (ps.period = 'year' AND ps.start = :year))
+                    FOR UPDATE
+                ''', chat=chat, month=month, year=year)
+            }
+            changed = [
+                dict(added, chat=chat, period=period, start=start)
+                for period, start, added in (
+                    (period, start, _added(_sketch_columns(periods.get((period, start))), hashtags, urls, user))
+                    for period, start in (('month', month), ('year', year))
+                )
+                if added is not None
+            ]
+            if len(changed) > 0:
+                self._execute(conn, self._upsert_period_sketch(), changed)
+
+    def unique_contributors(self, hashtag, chat_id):
+        data = self._execute(self._reader(chat_id), '''
+            SELECT ts.contributors
+            FROM tag_sketches ts
+            WHERE ts.chat = :chat_id
+              AND ts.hashtag = :tag
+        ''', tag=hashtag, chat_id=chat_id).scalar()
+        return hll.HyperLogLog.from_bytes(data).count()
+
+    def unique_counts(self, chat_id, from_=datetime.date.min, to=datetime.date.max):
+        """Approximate numbers of distinct tags, links and contributors within the days."""
+        tags, links, contributors = hll.HyperLogLog(), hll.HyperLogLog(), hll.HyperLogLog()
+        # whole years in the range, then whole months outside of them, then
+        # the days outside of those: at most 11 + 11 months and 30 + 30 days
+        # around the years (the rollups exist wherever a day sketch does)
+        for r in self._execute(self._reader(chat_id), '''
+            SELECT ps.tags, ps.links, ps.contributors
+            FROM period_sketches ps
+            WHERE ps.chat = :chat_id
+              AND ps.start >= :from_day
+              AND ps.start + CASE ps.period WHEN 'year' THEN interval '1 year' ELSE interval '1 month' END
+                  <= CAST(:to_day AS DATE) + 1
+              AND NOT (
+                  ps.period = 'month'
+                  AND date_trunc('year', ps.start::timestamp) >= :from_day
+                  AND date_trunc('year', ps.start::timestamp) + interval '1 year' <= CAST(:to_day AS DATE) + 1
+              )
+            UNION ALL
+            SELECT ds.tags, ds.links, ds.contributors
+            FROM day_sketches ds
+            WHERE ds.chat = :chat_id
+              AND ds.day >= :from_day AND ds.day <= :to_day
+              AND NOT (
+                  date_trunc('month', ds.day::timestamp) >= :from_day
+                  AND date_trunc('month', ds.day::timestamp) + interval '1 month' <= CAST(:to_day AS DATE) + 1
+              )
+        ''', chat_id=chat_id, from_day=from_, to_day=to):
+            tags.merge(hll.HyperLogLog.from_bytes(r['tags']))
+            links.merge(hll.HyperLogLog.from_bytes(r['links']))
+            contributors.merge(hll.HyperLogLog.from_bytes(r['contributors']))
+
+        return {
+            'tags': tags.count(),
+            'links': links.count(),
+            'contributors': contributors.count()
+        }
+
+    def _chunks(self, engine, query, chunk_size, **params):
+        # a server-side (named) cursor: memory use is bounded by chunk_size
+        # no matter how many rows the query returns
+        with engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(query, **params)
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if len(rows) == 0:
+                    break
+                yield rows
+
+    def export_chat(self, chat_id, chunk_size=1000):
+        """All messages of the chat with their tags, as lists of at most chunk_size rows."""
+        chunks = self._chunks(self._reader(chat_id), text('''
+            SELECT m.message_id, m.date, u.id AS user_id, u.username, coalesce(m.urls, a.urls) AS urls,
+                (
+                    SELECT array_agg(h.hashtag ORDER BY h.hashtag)
+                    FROM hashtags h
+                    WHERE h.message = m.id
+                      AND h.chat = m.chat
+                ) AS hashtags,
+                (
+                    SELECT lm.message_id
+                    FROM hashtags h
+                        INNER JOIN messages lm ON lm.id = h.linked_message AND lm.chat = h.chat
+                    WHERE h.message = m.id
+                      AND h.chat = m.chat
+                    LIMIT 1
+                ) AS linked_message_id,
+                coalesce(m.text, a.text) AS text, a.text_z
+            FROM messages m
+                INNER JOIN users u ON m."from" = u.id
+                LEFT JOIN messages_archive a ON a.message = m.id AND a.chat = m.chat
+            WHERE m.chat = :chat_id
+            ORDER BY m.id
+        '''), chunk_size, chat_id=chat_id)
+        for chunk in chunks:
+            yield [_unarchived(r) for r in chunk]
+
+    def messages_since(self, chat_id, after_id, chunk_size=10000):
+        """Messages of the chat with id > after_id (in id order) and their tags, in chunks."""
+        return self._chunks(self._reader(chat_id), text('''
+            SELECT m.id, m.date, m."from", coalesce(m.urls, a.urls) AS urls,
+                (
+                    SELECT array_agg(h.hashtag)
+                    FROM hashtags h
+                    WHERE h.message = m.id
+                      AND h.chat = m.chat
+                ) AS hashtags
+            FROM messages m
+                LEFT JOIN messages_archive a ON a.message = m.id AND a.chat = m.chat
+            WHERE m.chat = :chat_id
+                AND m.id > :after_id
+                AND m.message_id > 0
+            ORDER BY m.id
+        '''), chunk_size, chat_id=chat_id, after_id=after_id)
+
+    def archivable(self, before):
+        return self.engine.execute(text('''
+            SELECT count(*)
+            FROM messages m
+            WHERE m.date < :before
+              AND (m.text <> '' OR cardinality(m.urls) > 0)
+        '''), before=before).scalar()
+
+    def archive_messages(self, before, after_id=0, limit=1000, *, compress=False):
+        """Moves text and urls of up to `limit` messages older than `before`, with
+        id > after_id, to messages_archive. Returns their number and the last id."""
+        with self.engine.begin() as conn:
+            rows = conn.execute(text('''
+                SELECT m.id, m.chat, m.urls, m.text
+                FROM messages m
+                WHERE m.id > :after_id
+                  AND m.date < :before
+                  AND (m.text <> '' OR cardinality(m.urls) > 0)
+                ORDER BY m.id
+                LIMIT :limit
+                FOR UPDATE SKIP LOCKED
+            '''), after_id=after_id, before=before, limit=limit).fetchall()
+            if len(rows) == 0:
+                return 0, after_id
+
+            conn.execute(self.messages_archive.insert(), [
+                {
+                    'message': r['id'],
+                    'chat': r['chat'],
+                    'urls': r['urls'],
+                    'text': None if compress else r['text'],
+                    'text_z': zlib.compress(r['text'].encode()) if compress and r['text'] is not None else None
+                }
+                for r in rows
+            ])
+            conn.execute(text('''
+                UPDATE messages
+                SET urls = NULL, text = NULL
+                WHERE id = ANY(:ids)
+            '''), ids=[r['id'] for r in rows])
+        return len(rows), rows[-1]['id']
+
+    def enqueue_update(self, update_id, chat, payload):
+        return self.engine.execute(postgresql.insert(self.updates).on_conflict_do_nothing(), {
+            'update_id': update_id,
+            'chat': chat,
+            'payload': payload
+        })
+
+    def pending_updates(self, shard, shards, limit=100):
+        return self.engine.execute(text('''
+            SELECT update_id, payload
+            FROM updates
+            WHERE processed IS NULL
+              AND mod(abs(coalesce(chat, 0)), :shards) = :shard
+            ORDER BY update_id
+            LIMIT :limit
+        '''), shard=shard, shards=shards, limit=limit)
+
+    def mark_update_processed(self, update_id):
+        return self.engine.execute(text('''
+            UPDATE updates
+            SET processed = now()
+            WHERE update_id = :update_id
+        '''), update_id=update_id)
+
+    def purge_updates(self, older_than):
+        return self.engine.execute(text('''
+            DELETE FROM updates
+            WHERE processed < now() - :older_than
+        '''), older_than=older_than)
+
+
+def _unarchived(row):
+    row = dict(row)
+    text_z = row.pop('text_z')
+    if text_z is not None:
+        row['text'] = zlib.decompress(text_z).decode()
+    return row
+
+
+def _sketch_columns(row):
+    return (row['tags'], row['links'], row['contributors']) if row is not None else None
+
+
+def _added(sketches, hashtags, urls, user):
+    """The serialized (tags, links, contributors) `sketches` with a message
+    added, or None if they haven't changed."""
+    merged = [hll.HyperLogLog.from_bytes(v) for v in sketches] if sketches is not None else \
+        [hll.HyperLogLog(), hll.HyperLogLog(), hll.HyperLogLog()]
+    changes = [merged[0].update(hashtags), merged[1].update(urls), merged[2].add(user)]
+    if sketches is not None and not any(changes):
+        return None
+    return {
+        'tags': merged[0].to_bytes(),
+        'links': merged[1].to_bytes(),
+        'contributors': merged[2].to_bytes()
+    }
+
+
+def rebuild_sketches(conn, rows=None):
+    """Recomputes all tag and day sketches from the messages, or from `rows` of
+    (chat, date, user, urls, hashtags) when given."""
+    tags, days = {}, {}
+    result = rows if rows is not None else conn.execution_options(stream_results=True).execute(text('''
+        SELECT m.chat, m.date, m."from", coalesce(m.urls, a.urls) AS urls,
+            (
+                SELECT array_agg(h.hashtag)
+                FROM hashtags h
+                WHERE h.message = m.id
+                  AND h.chat = m.chat
+            ) AS hashtags
+        FROM messages m
+            LEFT JOIN messages_archive a ON a.message = m.id AND a.chat = m.chat
+        -- negative ids are placeholders registering chat members (see dumpchat.py)
+        WHERE m.message_id > 0
+    '''))
+    for chat, date, user, urls, hashtags in result:
+        for t in hashtags or []:
+            tags.setdefault((chat, t), hll.HyperLogLog()).add(user)
+        day = days.setdefault((chat, date.date()), (hll.HyperLogLog(), hll.HyperLogLog(), hll.HyperLogLog()))
+        day[0].update(hashtags or [])
+        day[1].update(urls or [])
+        day[2].add(user)
+
+    conn.execute(text('DELETE FROM tag_sketches; DELETE FROM day_sketches'))
+    if len(tags) > 0:
+        conn.execute(DB.tag_sketches.insert(), [
+            {'chat': chat, 'hashtag': t, 'contributors': sketch.to_bytes()}
+            for (chat, t), sketch in tags.items()
+        ])
+    if len(days) > 0:
+        conn.execute(DB.day_sketches.insert(), [
+            {
+                'chat': chat,
+                'day': day,
+                'tags': sketches[0].to_bytes(),
+                'links': sketches[1].to_bytes(),
+                'contributors': sketches[2].to_bytes()
+            }
+            for (chat, day), sketches in days.items()
+        ])
+
+
+def roll_up_sketches(conn):
+    """Recomputes the month and year sketches from the day sketches."""
+    periods = {}
+    for chat, day, *columns in conn.execution_options(stream_results=True).execute(text('''
+        SELECT ds.chat, ds.day, ds.tags, ds.links, ds.contributors
+        FROM day_sketches ds
+    ''')):
+        sketches = [hll.HyperLogLog.from_bytes(v) for v in columns]
+        for period, start in (('month', day.replace(day=1)), ('year', day.replace(month=1, day=1))):
+            merged = periods.setdefault((chat, period, start), (hll.HyperLogLog(), hll.HyperLogLog(), hll.HyperLogLog()))
+            for m, s in zip(merged, sketches):
+                m.merge(s)
+
+    conn.execute(text('DELETE FROM period_sketches'))
+    if len(periods) > 0:
+        conn.execute(DB.period_sketches.insert(), [
+            {
+                'chat': chat,
+                'period': period,
+                'start': start,
+                'tags': sketches[0].to_bytes(),
+                'links': sketches[1].to_bytes(),
+                'contributors': sketches[2].to_bytes()
+            }
+            for (chat, period, start), sketches in periods.items()
+        ])
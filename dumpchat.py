@@ -1,10 +1,12 @@
 import datetime
 import os
+import sys
 
 from telethon import TelegramClient
 from telethon.tl.types import MessageEntityUrl, MessageEntityTextUrl, MessageEntityHashtag
 
 import db
+import migrations
 
 api_id = int(os.environ['TG_API_ID'])
 api_hash = os.environ['TG_API_HASH']
@@ -57,7 +59,7 @@ async def dump_chat():
     music_vibes = int(os.environ['TG_INIT_CHAT_ID'])
 
     d = db.DB(full_uri=os.environ['DATABASE_URL'])
-    d.create_all()
+    migrations.check(d.engine)
 
     print('Processing "Music Vibes"...')
 
@@ -128,7 +130,7 @@ async def dump_chat():
         m_id = inserted_message.first()[0]
 
         if linked_message is not None:
-            res = d.find_message(linked_message.id).first()
+            res = d.find_message(linked_message.id, music_vibes).first()
             l_id = res[0] if res is not None else None
         else:
             l_id = None
@@ -136,13 +138,50 @@ async def dump_chat():
         hs = [
             d.make_hashtag(
                 message=m_id,
+                chat=music_vibes,
                 hashtag=hashtag,
                 linked_message=l_id
             ) for hashtag in get_hashtags(message)
         ]
 
         d.add_hashtags(hs)
+        d.add_chat_hashtags(music_vibes, get_hashtags(message))
+
+    # the messages were added around update_sketches()
+    migrations.rebuild_sketches(d.engine)
+    print('Rebuilt the sketches')
+
+
+async def verify_chat():
+    music_vibes = int(os.environ['TG_INIT_CHAT_ID'])
+
+    d = db.DB(full_uri=os.environ['DATABASE_URL'])
+    migrations.check(d.engine)
+
+    print('Verifying "Music Vibes"...')
+
+    checked = missing = changed = 0
+    for chunk in d.export_chat(music_vibes, chunk_size=100):
+        # skip the dummy messages registering the participants
+        rows = [r for r in chunk if r['message_id'] > 0]
+        if len(rows) == 0:
+            continue
+
+        messages = await client.get_messages(music_vibes, ids=[r['message_id'] for r in rows])
+        for r, message in zip(rows, messages):
+            checked += 1
+            if message is None:
+                missing += 1
+                print(f'Message {r["message_id"]} is gone from the chat')
+            elif sorted(get_urls(message)) != sorted(r['urls'] or []):
+                changed += 1
+                print(f'Links of message {r["message_id"]} differ')
+
+    print(f'Checked {checked} messages: {missing} missing, {changed} with different links')
 
 
 with client:
-    client.loop.run_until_complete(dump_chat())
+    if sys.argv[1:] == ['verify']:
+        client.loop.run_until_complete(verify_chat())
+    else:
+        client.loop.run_until_complete(dump_chat())
@@ -0,0 +1,68 @@
+import argparse
+import csv
+import json
+import os
+import sys
+
+import db
+
+# Streams all messages of a chat, with their links and tags, as CSV or JSON
+# Lines. Rows are read in chunks from a server-side cursor and written as
+# they come, so memory use stays flat regardless of the chat size.
+#
+#     python export.py -1001234567890 --format jsonl --output chat.jsonl
+
+FIELDS = ['message_id', 'date', 'user_id', 'username', 'urls', 'hashtags', 'linked_message_id', 'text']
+
+
+def write_csv(chunks, out):
+    writer = csv.writer(out)
+    writer.writerow(FIELDS)
+    for chunk in chunks:
+        for r in chunk:
+            writer.writerow([
+                r['message_id'],
+                r['date'].isoformat(),
+                r['user_id'],
+                r['username'],
+                ' '.join(r['urls'] or []),
+                ' '.join(r['hashtags'] or []),
+                r['linked_message_id'],
+                r['text'],
+            ])
+
+
+def write_jsonl(chunks, out):
+    for chunk in chunks:
+        for r in chunk:
+            row = dict(zip(FIELDS, (r[f] for f in FIELDS)))
+            row['date'] = row['date'].isoformat()
+            row['urls'] = row['urls'] or []
+            row['hashtags'] = row['hashtags'] or []
+            out.write(json.dumps(row, ensure_ascii=False))
+            out.write('\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the statistics of a chat')
+    parser.add_argument('chat_id', type=int)
+    parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv')
+    parser.add_argument('--output', help='file to write, stdout by default')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    d = db.DB(full_uri=os.environ['DATABASE_URL'], replica_uri=os.environ.get('DATABASE_REPLICA_URL', ''))
+    chunks = d.export_chat(args.chat_id, args.chunk_size)
+    write = write_csv if args.format == 'csv' else write_jsonl
+
+    if args.output:
+        with open(args.output, 'w', newline='', encoding='utf-8') as out:
+            write(chunks, out)
+    else:
+        write(chunks, sys.stdout)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
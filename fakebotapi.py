@@ -0,0 +1,228 @@
+import argparse
+import datetime
+import json
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+# A local stand-in for the Telegram Bot API.
+#
+# Answers every method with a plausible result, records the calls and can
+# simulate latency and flood limits (every n-th call answered with a 429).
+# Point the bot at it with TG_BASE_URL=http://127.0.0.1:8081/bot
+#
+#     python fakebotapi.py --port 8081 --latency 0.2 --flood-every 20
+#
+# --check instead drives a SendQueue against it and exits non-zero unless
+# replies are delivered, a 429 is retried and identical texts are coalesced,
+# and unless the bot's handlers answer a command (needs DATABASE_URL, as the
+# bot does).
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Hashtag Stats Bot', 'username': 'hashtagstatsbot'}
+
+
+class FakeBotAPI(object):
+    def __init__(self, host='127.0.0.1', port=0, *, latency=0.0, flood_every=0, retry_after=1):
+        self.latency = latency
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.calls = []
+        self._lock = threading.Lock()
+        self._message_id = 0
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                else:
+                    params = dict(parse_qsl(body.decode()))
+                status, response = api.handle(self.path.rsplit('/', 1)[-1], params)
+
+                data = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def handle(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.calls.append((time.monotonic(), method, params))
+            n = len(self.calls)
+            self._message_id += 1
+            message_id = self._message_id
+
+        if self.flood_every and n % self.flood_every == 0:
+            return 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after}
+            }
+
+        if method == 'getMe':
+            result = BOT_USER
+        elif method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            chat_id = int(params.get('chat_id', 0))
+            result = {
+                'message_id': message_id,
+                'from': BOT_USER,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+                'text': params.get('text', '')
+            }
+        elif method in ('getMyCommands', 'getUpdates'):
+            # PTB asks for the commands along with getMe, on the first bot.username
+            result = []
+        elif method == 'getChatMember':
+            result = {
+                'user': {'id': int(params.get('user_id', 0)), 'is_bot': False, 'first_name': 'User'},
+                'status': 'member'
+            }
+        else:
+            result = True
+
+        return 200, {'ok': True, 'result': result}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fakebotapi', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def check():
+    """Returns the list of failed checks of sendqueue.SendQueue and of the
+    bot's handlers against the fake API."""
+    import telegram
+    import sendqueue
+
+    api = FakeBotAPI(flood_every=3, retry_after=1).start()
+    outbox = sendqueue.SendQueue(
+        telegram.Bot('123:fake', base_url=api.base_url),
+        private_interval=0, group_interval=0, coalesce_window=60
+    )
+    group = telegram.Chat(-100, telegram.Chat.GROUP)
+    message = telegram.Message(7, None, datetime.datetime.now(), group)
+    try:
+        outbox.send_message(1, 'first')
+        outbox.reply_text(message, 'second')
+        outbox.reply_markdown(message, 'third')
+        outbox.send_message(1, 'first')  # coalesced with the first one
+        outbox.edit_message_text(message, 'edited')
+    finally:
+        outbox.stop()
+        api.stop()
+
+    calls = [(method, params) for _, method, params in api.calls]
+    sent = [p.get('text') for m, p in calls if m == 'sendMessage']
+    failures = []
+    if sorted(set(sent)) != ['first', 'second', 'third']:
+        failures.append(f'replies not delivered: {sent}')
+    if sent.count('first') != 1:
+        failures.append(f'identical texts not coalesced: {sent}')
+    if not all(int(p.get('reply_to_message_id', 0)) == 7 for m, p in calls if p.get('text') in ('second', 'third')):
+        failures.append('replies in the group do not quote the message')
+    if not any(m == 'editMessageText' and int(p.get('chat_id', 0)) == -100 for m, p in calls):
+        failures.append('message not edited')
+
+    # every 3rd call is answered with a 429 and has to be made again
+    if len(calls) != 5:
+        failures.append(f'expected 4 calls and one retry, got {[m for m, _ in calls]}')
+    elif calls[2] not in calls[3:]:
+        failures.append(f'{calls[2]} not retried after 429')
+    return failures + check_commands()
+
+
+def check_commands():
+    import telegram
+    from queue import Queue
+    from telegram.ext import Dispatcher
+
+    import hashtagstatsbot as bot
+    import sendqueue
+
+    api = FakeBotAPI().start()
+    tg = telegram.Bot('123:fake', base_url=api.base_url)
+    bot.outbox = sendqueue.SendQueue(tg, private_interval=0, group_interval=0, coalesce_window=0)
+    dispatcher = Dispatcher(tg, Queue(), use_context=True)
+    bot.register_handlers(dispatcher)
+
+    group = telegram.Chat(-100, telegram.Chat.GROUP)
+    user = telegram.User(2, 'User', False)
+    try:
+        for message_id, command in enumerate(['/help', f'/help@{BOT_USER["username"]}'], start=10):
+            message = telegram.Message(
+                message_id, user, datetime.datetime.now(), group, text=command, bot=tg,
+                entities=[telegram.MessageEntity(telegram.MessageEntity.BOT_COMMAND, 0, len(command))]
+            )
+            dispatcher.process_update(telegram.Update(message_id, message=message))
+    finally:
+        bot.outbox.stop()
+        api.stop()
+
+    answered = {
+        int(p.get('reply_to_message_id', 0))
+        for _, m, p in api.calls
+        if m == 'sendMessage' and p.get('text', '').startswith('Привет')
+    }
+    return [f'command {m} not answered' for m in (10, 11) if m not in answered]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local fake Telegram Bot API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every call')
+    parser.add_argument('--flood-every', type=int, default=0, help='answer every n-th call with 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--check', action='store_true', help='check sendqueue.SendQueue against it and exit')
+    args = parser.parse_args()
+
+    if args.check:
+        failures = check()
+        for f in failures:
+            print(f'FAIL: {f}')
+        print('OK' if len(failures) == 0 else f'{len(failures)} checks failed')
+        return 1 if failures else 0
+
+    api = FakeBotAPI(
+        args.host, args.port,
+        latency=args.latency, flood_every=args.flood_every, retry_after=args.retry_after
+    )
+    print(f'Serving on {api.base_url}')
+    try:
+        api.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,24 +1,47 @@
+import time
+
+# measured as early as possible, see on_first_update
+STARTED = time.monotonic()
+
+import datetime
 import logging
 import os
+import re
+import signal
 import telegram
+import threading
 
 from datetime import timedelta
-from delorean import Delorean
-from telegram import MessageEntity, ReplyKeyboardMarkup, ReplyKeyboardRemove, ParseMode
-from telegram.ext import CommandHandler, Filters, Job, MessageHandler, Updater
+from telegram import ChatMember, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity, ReplyKeyboardMarkup, ReplyKeyboardRemove, ParseMode
+from telegram.ext import CallbackQueryHandler, CommandHandler, Filters, Job, MessageHandler, TypeHandler, Updater
 from telegram.ext.jobqueue import Days
 
 import db
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG
-    # level=logging.INFO
+import lanes
+import logconfig
+import metrics
+import migrations
+import profiler
+import retention
+import sendqueue
+import tagindex
+
+logconfig.setup()
+
+logger = logging.getLogger(__name__)
+
+d = db.DB(
+    full_uri=os.environ['DATABASE_URL'],
+    replica_uri=os.environ.get('DATABASE_REPLICA_URL', ''),
+    max_staleness=float(os.environ.get('DATABASE_REPLICA_MAX_STALENESS', '5')),
+    # set to 0 behind a transaction-pooling pgbouncer
+    prepare=os.environ.get('DATABASE_PREPARE', '1') != '0'
 )
 
-logger = logging.Logger(__name__)
+# replies and digests, set up in main()
+outbox = None
 
-d = db.DB(full_uri=os.environ['DATABASE_URL'])
+known_tags = tagindex.TagIndex(lambda chat_id: [t['hashtag'] for t in d.chat_tags(chat_id)])
 
 
 def error(update, context):
@@ -27,7 +50,8 @@ def error(update, context):
 
 
 def on_help(update, context):
-    update.message.reply_markdown(
+    outbox.reply_markdown(
+        update.message,
         'Привет! Я *Hashtag Stats Bot*.\n\n'
         'Я сохраняю статистику по тегам в групповых чатах. '
         'Просто добавьте меня в один из оных.\n\n'
@@ -35,6 +59,10 @@ def on_help(update, context):
         '/stats — Различного рода глобальная статистика\n'
         '/tag `#hashtag` — Статистика по конкретному тегу\n'
         '/user `@mention` — Статистика по конкретному пользователю\n'
+        '/exclude `#hashtag` — Исключить личный тег из статистики (для админов)\n'
+        '/include `#hashtag` — Вернуть тег в статистику (для админов)\n'
+        '/excluded — Список исключённых тегов\n'
+        '/year `[год]` — Итоги года: активность, пары тегов, серии, сервисы\n'
         '/help — Показывает это сообщение\n'
     )
     # context.bot.send_message(chat_id=update.effective_chat.id, text="I'm a bot, please talk to me!")
@@ -103,7 +131,7 @@ def on_new_message(update: telegram.Update, context):
             if len(other_urls) > 0:
                 # okay, we've found something
                 # let's check if we have that message in the database
-                res = d.find_message(m.reply_to_message.message_id).first()
+                res = d.find_message(m.reply_to_message.message_id, c.id).first()
                 l_id = res[0] if res is not None else None
             else:
                 # seems like just a message with list of tags.
@@ -132,12 +160,16 @@ def on_new_message(update: telegram.Update, context):
     hs = [
         d.make_hashtag(
             message=m_id,
+            chat=c.id,
             hashtag=hashtag,
             linked_message=l_id
         ) for hashtag in hashtags
     ]
 
     d.add_hashtags(hs, overwrite=is_edit)
+    d.add_chat_hashtags(c.id, hashtags)
+    known_tags.add(c.id, hashtags)
+    d.update_sketches(c.id, m.date, u.id, hashtags, urls)
 
 
 def mention_user(id, first_name, last_name=None, username=None):
@@ -158,7 +190,8 @@ def tr(word, n):
         'раз': ['раза', 'раз'],
         'тега': ['тегов', 'тегов'],
         'ссылки': ['ссылок', 'ссылок'],
-        'штука': ['штуки', 'штук']
+        'штука': ['штуки', 'штук'],
+        'секунду': ['секунды', 'секунд']
     }
 
     if 5 <= (n % 100) <= 20:
@@ -179,6 +212,14 @@ def on_tag_stats(update, context):
         if not hashtag.startswith('#'):
             raise ValueError()
 
+        if not known_tags.known(chat_id, hashtag):
+            reply = f'Хэштег {hashtag} в этом чате пока не использовался.'
+            suggestions = known_tags.suggest(chat_id, hashtag)
+            if len(suggestions) > 0:
+                reply += f' Возможно, вы имели в виду {" ".join(escape_markdown_tags(suggestions))}?'
+            outbox.reply_markdown(update.message, reply)
+            return
+
         reply = ''
 
         count = d.links_by_tag(hashtag, chat_id).fetchone()
@@ -187,6 +228,10 @@ def on_tag_stats(update, context):
         else:
             reply += f'Хэштег {hashtag} в этом чате пока не использовался.'
 
+        contributors = d.unique_contributors(hashtag, chat_id)
+        if contributors > 1:
+            reply += f' Под ним отметилось около *{contributors}* участников.'
+
         author = d.author_of_tag(hashtag, chat_id).fetchone()
         contrib = d.contributor_of_tag(hashtag, chat_id).fetchone()
 
@@ -217,10 +262,10 @@ def on_tag_stats(update, context):
                     tr("сообщение", contrib["count"])
                 }* под этим тегом, что является абсолютным большинством. Так держать!'''
 
-        update.message.reply_markdown(reply)
+        outbox.reply_markdown(update.message, reply)
 
     except (IndexError, ValueError):
-        update.message.reply_text('Использование: /tag #hashtag')
+        outbox.reply_text(update.message, 'Использование: /tag #hashtag')
 
 
 def escape_markdown_tag(tag):
@@ -290,16 +335,152 @@ def on_user_stats(update, context):
         if tags is not None and len(tags["tags"]) > 0:
             reply += f'\n\nАвтор тегов: {" ".join(sorted(escape_markdown_tags(tags["tags"])))}'
 
-        update.message.reply_markdown(reply)
+        outbox.reply_markdown(update.message, reply)
     except (IndexError, ValueError):
-        update.message.reply_markdown('Использование: /user @mention')
+        outbox.reply_markdown(update.message, 'Использование: /user @mention')
+
+
+# leaves room for Markdown and stays well below Telegram's 4096 characters
+TAGS_PAGE_LENGTH = 3500
+
+# Telegram rejects inline keyboards of more than 100 buttons; 12 rows of 8
+# leave room for the navigation row
+MAX_INITIALS = 96
+
+
+def callback_cursor(prefix, tag):
+    # callback data is limited to 64 bytes: a truncated cursor may repeat
+    # a few tags on the next page, but never skips any
+    return prefix + tag.encode()[:64 - len(prefix.encode())].decode(errors='ignore')
+
+
+def tags_page(chat_id, after='', inclusive=False):
+    limit = 300
+    tags = [t['hashtag'] for t in d.tags_page(chat_id, after, limit, inclusive=inclusive).fetchall()]
+
+    shown, length = [], 0
+    for t in tags:
+        length += len(escape_markdown_tag(t)) + 1
+        if length > TAGS_PAGE_LENGTH:
+            break
+        shown.append(t)
+
+    if len(shown) == 0 and not after:
+        return 'Похоже, в этом чате пока нет полезных тегов (или я о них не знаю).', None
+
+    navigation = []
+    if after:
+        navigation.append(InlineKeyboardButton('« В начало', callback_data='tags='))
+    if len(shown) < len(tags) or len(tags) == limit:
+        navigation.append(InlineKeyboardButton('Дальше »', callback_data=callback_cursor('tags>', shown[-1])))
+
+    if len(navigation) == 0:
+        # everything fits on a single page
+        return ' '.join(escape_markdown_tags(shown)), None
+
+    # with more letters than buttons (a chat using several scripts), a button
+    # jumps to the first of a run of letters
+    initials = known_tags.initials(chat_id, d.excluded_tags(chat_id))
+    step = max(1, -(-len(initials) // MAX_INITIALS))
+    buttons = [
+        InlineKeyboardButton(
+            run[0].upper() if len(run) == 1 else f'{run[0].upper()}–{run[-1].upper()}',
+            callback_data=callback_cursor('tags=', '#' + run[0])
+        )
+        for run in (initials[n : n + step] for n in range(0, len(initials), step))
+    ]
+    keyboard = [navigation] + [buttons[n : n + 8] for n in range(0, len(buttons), 8)]
+
+    reply = ' '.join(escape_markdown_tags(shown)) if len(shown) > 0 else 'Больше тегов нет.'
+    return reply, InlineKeyboardMarkup(keyboard)
+
+
+def on_tags_page(update, context):
+    query = update.callback_query
+    inclusive, after = query.data[4] == '=', query.data[5:]
+
+    reply, markup = tags_page(update.effective_chat.id, after, inclusive)
+    outbox.answer_callback_query(query)
+    outbox.edit_message_text(query.message, reply, parse_mode=ParseMode.MARKDOWN, reply_markup=markup)
+
+
+def is_admin(update, context):
+    chat = update.effective_chat
+    if chat.type == telegram.Chat.PRIVATE:
+        return True
+
+    member = context.bot.get_chat_member(chat.id, update.effective_user.id)
+    return member.status in (ChatMember.ADMINISTRATOR, ChatMember.CREATOR)
+
+
+def get_command_tags(context):
+    tags = [t for t in context.args if t.startswith('#')]
+    if len(tags) == 0 or len(tags) != len(context.args):
+        raise ValueError()
+    return tags
+
+
+def on_exclude_tags(update, context):
+    try:
+        tags = get_command_tags(context)
+
+        if not is_admin(update, context):
+            outbox.reply_text(update.message, 'Исключать теги могут только админы чата.')
+            return
+
+        # a personal tag belongs to the author of the message replied to
+        m = update.message
+        owner = m.reply_to_message.from_user if m.reply_to_message is not None else m.from_user
+        d.add_user(
+            id=owner.id,
+            first_name=owner.first_name,
+            last_name=owner.last_name,
+            username=owner.username,
+            is_bot=owner.is_bot
+        )
+        d.add_chat(id=m.chat.id, type_=m.chat.type)
+
+        for t in tags:
+            d.exclude_tag(m.chat.id, owner.id, t)
+
+        outbox.reply_markdown(m, f'Исключено из статистики: {" ".join(escape_markdown_tags(tags))}')
+
+    except ValueError:
+        outbox.reply_text(update.message, 'Использование: /exclude #hashtag')
+
+
+def on_include_tags(update, context):
+    try:
+        tags = get_command_tags(context)
+
+        if not is_admin(update, context):
+            outbox.reply_text(update.message, 'Возвращать теги могут только админы чата.')
+            return
+
+        chat_id = update.effective_chat.id
+        for t in tags:
+            d.include_tag(chat_id, t)
+
+        outbox.reply_markdown(update.message, f'Снова в статистике: {" ".join(escape_markdown_tags(tags))}')
+
+    except ValueError:
+        outbox.reply_text(update.message, 'Использование: /include #hashtag')
+
+
+def on_excluded_tags(update, context):
+    tags = d.excluded_tags(update.effective_chat.id)
+    if len(tags) > 0:
+        reply = f'Не учитываются в статистике: {" ".join(sorted(escape_markdown_tags(tags)))}'
+    else:
+        reply = 'В этом чате все теги учитываются в статистике.'
+    outbox.reply_markdown(update.message, reply)
 
 
 def on_stats(update, context):
-    update.message.reply_markdown('Что вы хотите увидеть?', reply_markup=ReplyKeyboardMarkup([
+    outbox.reply_markdown(update.message, 'Что вы хотите увидеть?', reply_markup=ReplyKeyboardMarkup([
         ['ТОП-10 тегов', 'Все теги'],
         ['ТОП-5 контрибьютеров', 'БОТТОМ-5 контрибьютеров'],
-        ['ТОП музыкальных сервисов']
+        ['ТОП музыкальных сервисов', 'Уникальные значения']
     ], one_time_keyboard=True))
 
 
@@ -311,6 +492,8 @@ def leaderboard(iterable):
 
 
 def weekly_contributors(chat_id):
+    from delorean import Delorean
+
     def format_date(date):
         return date.strftime('%d.%m.%Y')
 
@@ -339,10 +522,12 @@ def weekly_contributors(chat_id):
 def on_weekly_stats(context):
     chat_id = context.job.context
     reply = weekly_contributors(chat_id)
-    context.bot.send_message(chat_id, reply, parse_mode=ParseMode.MARKDOWN, disable_notification=True)
+    outbox.send_message(chat_id, reply, parse_mode=ParseMode.MARKDOWN, disable_notification=True)
 
 
 def enable_weekly_stats(update, context):
+    from delorean import Delorean
+
     chat_id = update.effective_chat.id
 
     if 'weekly_stats' in context.chat_data:
@@ -358,7 +543,7 @@ def enable_weekly_stats(update, context):
     )
     context.chat_data['weekly_stats'] = new_job
 
-    context.bot.send_message(chat_id, 'Еженедельные дайджесты включены.')
+    outbox.send_message(chat_id, 'Еженедельные дайджесты включены.')
 
 
 def disable_weekly_stats(update, context):
@@ -367,20 +552,22 @@ def disable_weekly_stats(update, context):
         old_job.schedule_removal()
 
 
-def on_detailed_stats(update, context):
-    def nice_category(category):
-        names = {
-            'spotify': 'Spotify',
-            'youtube': 'YouTube',
-            'deezer': 'Deezer',
-            'google': 'Google Play Music',
-            'itunes': 'Apple Music',
-            'soundcloud': 'SoundCloud'
-        }
-        return names.get(category, category)
+def nice_category(category):
+    names = {
+        'spotify': 'Spotify',
+        'youtube': 'YouTube',
+        'deezer': 'Deezer',
+        'google': 'Google Play Music',
+        'itunes': 'Apple Music',
+        'soundcloud': 'SoundCloud'
+    }
+    return names.get(category, category)
+
 
+def on_detailed_stats(update, context):
     chat_id = update.effective_chat.id
     m = update.message
+    markup = ReplyKeyboardRemove()
 
     if m.text == 'ТОП-10 тегов':
         tags = d.top_tags(chat_id).fetchall()
@@ -397,12 +584,9 @@ def on_detailed_stats(update, context):
             reply = 'Похоже, в этом чате пока нет полезных тегов (или я о них не знаю).'
 
     elif m.text == 'Все теги':
-        tags = d.all_tags(chat_id).fetchall()
-        if tags is not None:
-            hs = escape_markdown_tags([t['hashtag'] for t in tags])
-            reply = ' '.join(hs)
-        else:
-            reply = 'Похоже, в этом чате пока нет полезных тегов (или я о них не знаю).'
+        reply, tags_markup = tags_page(chat_id)
+        if tags_markup is not None:
+            markup = tags_markup
 
     elif m.text == 'ТОП-5 контрибьютеров':
         contribs = d.top_contributors(chat_id).fetchall()
@@ -449,21 +633,195 @@ def on_detailed_stats(update, context):
         else:
             reply = 'Увы, я пока не в курсе ни о каких ссылках в этом чате.'
 
-    m.reply_markdown(reply, reply_markup=ReplyKeyboardRemove())
+    elif m.text == 'Уникальные значения':
+        today = datetime.date.today()
+        periods = [
+            ('За неделю', d.unique_counts(chat_id, today - timedelta(days=6), today)),
+            ('За месяц', d.unique_counts(chat_id, today - timedelta(days=29), today)),
+            ('За всё время', d.unique_counts(chat_id))
+        ]
 
+        reply = '*Уникальные значения* (приблизительно):\n\n'
+        reply += '\n\n'.join(
+            f'_{name}_\nТегов: {u["tags"]}\nСсылок: {u["links"]}\nКонтрибьютеров: {u["contributors"]}'
+            for name, u in periods
+        )
 
+    outbox.reply_markdown(m, reply, reply_markup=markup)
 
 
-def main(webhook=False):
-    d.create_all()
+def sparkline(values, top):
+    bars = ' ▁▂▃▄▅▆▇█'
+    return ''.join(bars[0 if v == 0 else 1 + (len(bars) - 2) * v // top] for v in values)
 
-    TOKEN = os.environ['TG_TOKEN']
-    updater = Updater(token=TOKEN, use_context=True)
 
-    dispatcher = updater.dispatcher
-    job_queue = updater.job_queue
+def on_year(update, context):
+    try:
+        import analytics  # needs numpy, an optional dependency
+    except ImportError:
+        outbox.reply_text(update.message, 'Итоги года недоступны: на сервере не установлен numpy.')
+        return
+
+    chat_id = update.effective_chat.id
+    try:
+        year = int(context.args[0]) if len(context.args) > 0 else datetime.date.today().year
+        # the report covers [year, year + 1)
+        if not datetime.MINYEAR <= year < datetime.MAXYEAR:
+            raise ValueError(year)
+    except ValueError:
+        outbox.reply_markdown(update.message, 'Использование: /year `[год]`')
+        return
+
+    snapshot = analytics.snapshot_of(chat_id)
+    snapshot.refresh(d, chat_id)
+    r = analytics.year_in_review(snapshot, year)
+
+    if r['messages'] == 0:
+        outbox.reply_text(update.message, f'В {year} году здесь было тихо: я не знаю ни одного сообщения.')
+        return
+
+    reply = f'*Итоги {year} года* ({r["messages"]} {tr("сообщение", r["messages"])})\n\n'
+
+    heatmap = r['heatmap']
+    weekdays = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
+    top = int(heatmap.max())
+    reply += '_Активность по часам (UTC)_\n'
+    reply += '\n'.join(f'`{w} {sparkline(row.tolist(), top)}`' for w, row in zip(weekdays, heatmap))
+    busiest = int(heatmap.argmax())
+    reply += f'\nСамое оживлённое время: {weekdays[busiest // 24]}, {busiest % 24}:00.\n\n'
+
+    if len(r['cooccurrence']) > 0:
+        reply += '_Теги, которые ходят парой_\n'
+        reply += '\n'.join(
+            f'{n} {escape_markdown_tag(a)} + {escape_markdown_tag(b)} ({c} {tr("раз", c)})'
+            for n, (a, b, c) in leaderboard(r['cooccurrence'])
+        )
+        reply += '\n\n'
+
+    users = {u['id']: u for u in d.users_by_id(u for u, _ in r['streaks'])}
+    reply += '_Самые длинные серии_ (дней подряд)\n'
+    reply += '\n'.join(
+        f'{n} {mention_user(u, users[u]["first_name"], users[u]["last_name"], users[u]["username"])} ({days})'
+        for n, (u, days) in leaderboard(r['streaks'])
+        if u in users
+    )
+
+    quarters = r['services_by_quarter']
+    if quarters.sum() > 0:
+        reply += '\n\n_Доли сервисов по кварталам_\n'
+        for q, counts in zip(['I', 'II', 'III', 'IV'], quarters.tolist()):
+            total = sum(counts)
+            if total == 0:
+                continue
+            shares = sorted(
+                ((c / total, nice_category(s) if s != 'other' else 'прочее') for s, c in zip(r['services'], counts) if c > 0),
+                reverse=True
+            )
+            reply += f'{q}: ' + ', '.join(f'{name} {share:.0%}' for share, name in shares) + '\n'
+
+    outbox.reply_markdown(update.message, reply)
+
+
+
+
+# threads running handlers, jobs and sends; MainThread for the workers of workqueue.py
+PROFILED_THREADS = re.compile(r'^(MainThread|lane-\d+|sender-\d+|retention|Bot:\d+:(dispatcher|job_queue|worker:.*))$')
+
+
+def admin_ids():
+    # the bot's operators, not admins of a chat (see is_admin)
+    return {int(i) for i in os.environ.get('TG_ADMIN_IDS', '').split(',') if i.strip() != ''}
+
+
+def send_profile(chat_ids, seconds):
+    profile = profiler.sample(seconds, threads=PROFILED_THREADS)
+    if profile is None:
+        for chat_id in chat_ids:
+            outbox.send_message(chat_id, 'Профилирование уже идёт, дождитесь его результатов.')
+        return
+
+    summary = profile.summary()
+    logger.info('Profile of %d s:\n%s', seconds, summary)
+    filename = f'profile-{datetime.datetime.utcnow():%Y%m%d-%H%M%S}.txt'
+    if len(chat_ids) == 0:
+        with open(os.path.join(os.environ.get('PROFILE_DIR', '.'), filename), 'w') as f:
+            f.write(profile.collapsed())
+        logger.info('Profile stacks written to %s', f.name)
+        return
+
+    data = profile.collapsed().encode()
+    for chat_id in chat_ids:
+        outbox.send_message(chat_id, f'```\n{summary}\n```', parse_mode=ParseMode.MARKDOWN)
+        outbox.send_document(chat_id, data, filename, caption='Стеки для flamegraph.pl или speedscope.app')
+
+
+def start_profile(chat_ids, seconds):
+    # sampling takes a while, don't hold up the lane (or the signal handler)
+    threading.Thread(target=send_profile, args=(chat_ids, seconds), name='profiler', daemon=True).start()
+
+
+def on_profile(update, context):
+    if update.effective_user.id not in admin_ids():
+        outbox.reply_text(update.message, 'Профилировать бота могут только его администраторы.')
+        return
+
+    try:
+        seconds = int(context.args[0]) if len(context.args) > 0 else 30
+    except ValueError:
+        outbox.reply_markdown(update.message, 'Использование: /profile `[секунд]`')
+        return
+
+    seconds = max(1, min(seconds, 300))
+    outbox.reply_text(update.message, f'Профилирую {seconds} {tr("секунду", seconds)}, результаты пришлю сюда.')
+    start_profile([update.effective_chat.id], seconds)
+
+
+def on_profile_signal(signum, frame):
+    # kill -USR1 <pid>: the results go to the private chats of TG_ADMIN_IDS
+    start_profile(sorted(admin_ids()), int(os.environ.get('PROFILE_SECONDS', '30')))
 
 
+def on_enqueue(update, context):
+    chat = update.effective_chat
+    d.enqueue_update(update.update_id, chat.id if chat is not None else None, update.to_dict())
+
+
+def on_purge_updates(context):
+    d.purge_updates(timedelta(days=1))
+
+
+def on_archive(context):
+    # batches can take a while, don't hold up the other jobs
+    threading.Thread(
+        target=retention.archive,
+        args=(d, timedelta(days=int(os.environ['RETENTION_DAYS']))),
+        kwargs={'compress': os.environ.get('RETENTION_COMPRESS') == '1'},
+        name='retention',
+        daemon=True
+    ).start()
+
+
+first_update_served = False
+
+
+def on_first_update(update, context):
+    global first_update_served
+    if not first_update_served:
+        first_update_served = True
+        elapsed = time.monotonic() - STARTED
+        metrics.gauge('startup.first_update', elapsed)
+        logger.info('First update served %.3f s after start', elapsed)
+
+
+def on_log_metrics(context):
+    executor = context.job.context
+    if executor is not None:
+        executor.update_metrics()
+    metrics.gauge('sendqueue.depth', outbox.depth())
+    logger.info('Metrics: %s', metrics.format_snapshot())
+
+
+def register_handlers(dispatcher):
     start_handler = CommandHandler('start', on_help)
     help_handler = CommandHandler('help', on_help)
     dispatcher.add_handler(start_handler)
@@ -481,15 +839,33 @@ def main(webhook=False):
     disable_weekly_handler = CommandHandler('weekly', enable_weekly_stats)
     dispatcher.add_handler(disable_weekly_handler)
 
+    exclude_handler = CommandHandler('exclude', on_exclude_tags)
+    dispatcher.add_handler(exclude_handler)
+
+    include_handler = CommandHandler('include', on_include_tags)
+    dispatcher.add_handler(include_handler)
+
+    excluded_handler = CommandHandler('excluded', on_excluded_tags)
+    dispatcher.add_handler(excluded_handler)
+
     stats_handler = CommandHandler('stats', on_stats)
     dispatcher.add_handler(stats_handler)
 
+    year_handler = CommandHandler('year', on_year)
+    dispatcher.add_handler(year_handler)
+
+    profile_handler = CommandHandler('profile', on_profile)
+    dispatcher.add_handler(profile_handler)
+
     stats_details_handler = MessageHandler(
-        Filters.regex('^(ТОП-10 тегов|Все теги|ТОП-5 контрибьютеров|БОТТОМ-5 контрибьютеров|ТОП музыкальных сервисов)$'),
+        Filters.regex('^(ТОП-10 тегов|Все теги|ТОП-5 контрибьютеров|БОТТОМ-5 контрибьютеров|ТОП музыкальных сервисов|Уникальные значения)$'),
         on_detailed_stats
     )
     dispatcher.add_handler(stats_details_handler)
 
+    tags_page_handler = CallbackQueryHandler(on_tags_page, pattern='^tags[>=]')
+    dispatcher.add_handler(tags_page_handler)
+
     new_msg_handler = MessageHandler(
         Filters.entity(MessageEntity.HASHTAG) |
             Filters.entity(MessageEntity.URL) |
@@ -500,6 +876,43 @@ def main(webhook=False):
 
     dispatcher.add_error_handler(error)
 
+    for group in dispatcher.handlers.values():
+        for handler in group:
+            handler.callback = logconfig.traced(handler.callback)
+
+
+def main(webhook=False, enqueue_only=False):
+    from delorean import Delorean
+
+    global outbox
+
+    migrations.check(d.engine)
+
+    TOKEN = os.environ['TG_TOKEN']
+    updater = Updater(token=TOKEN, base_url=os.environ.get('TG_BASE_URL'), use_context=True)
+    outbox = sendqueue.SendQueue(updater.bot)
+
+    dispatcher = updater.dispatcher
+    job_queue = updater.job_queue
+
+    dispatcher.add_handler(TypeHandler(telegram.Update, on_first_update), group=-1)
+
+    executor = None
+    if enqueue_only:
+        # the handlers are run by the workers from workqueue.py
+        dispatcher.add_handler(TypeHandler(telegram.Update, on_enqueue))
+        dispatcher.add_error_handler(error)
+        job_queue.run_repeating(on_purge_updates, interval=timedelta(hours=1))
+    else:
+        register_handlers(dispatcher)
+        # updates of one chat are handled in order, different chats in parallel
+        executor = lanes.shard_dispatcher(dispatcher, int(os.environ.get('DISPATCH_LANES', '4')))
+
+    job_queue.run_repeating(on_log_metrics, interval=timedelta(minutes=1), context=executor)
+    signal.signal(signal.SIGUSR1, on_profile_signal)
+    if 'RETENTION_DAYS' in os.environ:
+        job_queue.run_daily(on_archive, datetime.time(hour=4))
+
     new_job = Job(
         on_weekly_stats,
         interval=timedelta(weeks=1),
@@ -528,6 +941,11 @@ def main(webhook=False):
 
     updater.idle()
 
+    if executor is not None:
+        executor.stop()
+    outbox.stop()
+    logconfig.stop()
+
 
 if __name__ == "__main__":
-    main(webhook=True)
+    main(webhook=True, enqueue_only=os.environ.get('UPDATE_QUEUE') == '1')
@@ -0,0 +1,59 @@
+import hashlib
+import math
+import zlib
+
+# HyperLogLog cardinality sketches.
+#
+# 2^10 one-byte registers give a standard error of about 3%. Sketches are
+# mergeable (register-wise max), so the distinct count of any union of days
+# or tags is the count of the merged sketch. Serialized with zlib: a sparse
+# sketch of a rarely used tag takes a few dozen bytes instead of a kilobyte.
+
+P = 10
+M = 1 << P
+ALPHA = 0.7213 / (1 + 1.079 / M)
+
+
+def _hash(value):
+    # stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+
+class HyperLogLog(object):
+    def __init__(self, registers=None):
+        self.registers = bytearray(registers) if registers is not None else bytearray(M)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(zlib.decompress(data)) if data else cls()
+
+    def to_bytes(self):
+        return zlib.compress(bytes(self.registers))
+
+    def add(self, value):
+        """Returns whether the sketch has changed."""
+        h = _hash(value)
+        index = h >> (64 - P)
+        rank = (64 - P) - (h & ((1 << (64 - P)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def update(self, values):
+        changed = False
+        for v in values:
+            changed = self.add(v) or changed
+        return changed
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        estimate = ALPHA * M * M / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * M and zeros > 0:
+            # linear counting is more precise for small cardinalities
+            return round(M * math.log(M / zeros))
+        return round(estimate)
@@ -0,0 +1,72 @@
+import logging
+import queue
+import threading
+import time
+
+from telegram import Update
+
+import metrics
+
+# Per-chat ordered execution of updates.
+#
+# Every chat is pinned to one lane (a thread with its own queue), so updates
+# of the same chat are handled strictly one after another, while different
+# chats proceed in parallel on the other lanes.
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedExecutor(object):
+    def __init__(self, lanes, name='lane'):
+        self.name = name
+        self.queues = [queue.Queue() for _ in range(lanes)]
+        self.threads = [
+            threading.Thread(target=self._run, args=(i,), name=f'{name}-{i}', daemon=True)
+            for i in range(lanes)
+        ]
+        for t in self.threads:
+            t.start()
+
+    def lane_of(self, key):
+        return abs(key or 0) % len(self.queues)
+
+    def submit(self, key, fn, *args):
+        self.queues[self.lane_of(key)].put((time.monotonic(), fn, args))
+
+    def _run(self, lane):
+        q = self.queues[lane]
+        while True:
+            item = q.get()
+            if item is None:
+                break
+
+            enqueued, fn, args = item
+            metrics.gauge(f'{self.name}.{lane}.lag', time.monotonic() - enqueued)
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception('Unhandled error on %s-%d', self.name, lane)
+            metrics.inc(f'{self.name}.{lane}.processed')
+
+    def update_metrics(self):
+        for lane, q in enumerate(self.queues):
+            metrics.gauge(f'{self.name}.{lane}.depth', q.qsize())
+
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+
+
+def shard_dispatcher(dispatcher, lanes):
+    """Route every update of the dispatcher through a lane chosen by its chat."""
+    executor = ShardedExecutor(lanes)
+    process_update = dispatcher.process_update
+
+    def sharded_process_update(update):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        executor.submit(chat.id if chat is not None else 0, process_update, update)
+
+    dispatcher.process_update = sharded_process_update
+    return executor
@@ -0,0 +1,277 @@
+import argparse
+import json
+import logging
+import random
+import sys
+import threading
+import time
+
+from collections import defaultdict
+
+from sqlalchemy import event
+from telegram import Bot, Update
+from telegram.ext import Updater
+
+import fakebotapi
+import hashtagstatsbot as bot
+import lanes
+import migrations
+import sendqueue
+
+# Load test for the handlers registered in main().
+#
+# Generates (or replays) a stream of updates and feeds it at a given rate
+# through the same dispatcher setup as production: per-chat lanes, the real
+# DB (DATABASE_URL, use a scratch database!) and a fake Bot API. Reports
+# throughput, latency percentiles, SQL statements and handler errors per
+# update type.
+#
+#     DATABASE_URL=postgresql://localhost/loadtest python loadtest.py --rate 200 --updates 5000
+
+COMMANDS = ['/stats', '/tag {tag}', '/user @{username}', '/excluded', '/help']
+STATS_BUTTONS = ['ТОП-10 тегов', 'Все теги', 'ТОП-5 контрибьютеров', 'БОТТОМ-5 контрибьютеров', 'ТОП музыкальных сервисов']
+TAGS = [f'#{genre}' for genre in (
+    'rock', 'jazz', 'blues', 'metal', 'punk', 'indie', 'folk', 'soul', 'funk', 'disco',
+    'techno', 'house', 'ambient', 'classical', 'hiphop', 'rap', 'pop', 'reggae', 'ska', 'grunge'
+)]
+SERVICES = [
+    'https://open.spotify.com/track/{}',
+    'https://youtu.be/{}',
+    'https://www.deezer.com/track/{}',
+    'https://soundcloud.com/artist/{}',
+    'https://example.com/{}',
+]
+
+
+class Generator(object):
+    """A deterministic stream of realistic update payloads."""
+
+    def __init__(self, chats, users, mix, seed=0):
+        self.random = random.Random(seed)
+        self.chats = [-1000000000000 - i for i in range(chats)]
+        self.users = {
+            c: [
+                {'id': 100000 + i * users + j, 'is_bot': False, 'first_name': f'User{j}', 'username': f'user_{i}_{j}'}
+                for j in range(users)
+            ] for i, c in enumerate(self.chats)
+        }
+        self.kinds = list(mix.keys())
+        self.weights = list(mix.values())
+        self.update_id = 0
+        self.message_id = defaultdict(int)
+        self.sent = defaultdict(list)  # chat -> messages with links
+
+    def _message(self, chat, text, entities):
+        self.message_id[chat] += 1
+        return {
+            'message_id': self.message_id[chat],
+            'from': self.random.choice(self.users[chat]),
+            'date': int(time.time()),
+            'chat': {'id': chat, 'type': 'supergroup', 'title': 'Load test'},
+            'text': text,
+            'entities': entities,
+        }
+
+    def _tagged(self, chat, with_url=True):
+        tags = self.random.sample(TAGS, self.random.randint(1, 3))
+        text, entities = '', []
+        if with_url:
+            url = self.random.choice(SERVICES).format(self.random.getrandbits(40))
+            entities.append({'type': 'url', 'offset': 0, 'length': len(url)})
+            text = url + ' '
+        for t in tags:
+            entities.append({'type': 'hashtag', 'offset': len(text), 'length': len(t)})
+            text += t + ' '
+        return self._message(chat, text.strip(), entities)
+
+    def _command(self, chat):
+        command, _, args = self.random.choice(COMMANDS).partition(' ')
+        if self.random.random() < 0.5:
+            # as sent from the command menu of a group
+            command += f'@{fakebotapi.BOT_USER["username"]}'
+        args = args.format(tag=self.random.choice(TAGS), username=self.random.choice(self.users[chat])['username'])
+
+        entities = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        if args.startswith('#'):
+            entities.append({'type': 'hashtag', 'offset': len(command) + 1, 'length': len(args)})
+        elif args.startswith('@'):
+            entities.append({'type': 'mention', 'offset': len(command) + 1, 'length': len(args)})
+        return self._message(chat, f'{command} {args}'.strip(), entities)
+
+    def next(self):
+        self.update_id += 1
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        chat = self.random.choice(self.chats)
+        update = {'update_id': self.update_id}
+
+        if kind == 'reply' and self.sent[chat]:
+            m = self._tagged(chat, with_url=False)
+            m['reply_to_message'] = self.random.choice(self.sent[chat])
+            update['message'] = m
+        elif kind == 'edit' and self.sent[chat]:
+            original = self.random.choice(self.sent[chat])
+            edited = dict(self._tagged(chat), message_id=original['message_id'], edit_date=int(time.time()))
+            self.message_id[chat] -= 1
+            update['edited_message'] = edited
+        elif kind == 'stats':
+            text = self.random.choice(STATS_BUTTONS)
+            update['message'] = self._message(chat, text, [])
+        elif kind == 'command':
+            update['message'] = self._command(chat)
+        else:
+            kind = 'message'
+            m = self._tagged(chat)
+            self.sent[chat] = (self.sent[chat] + [m])[-50:]
+            update['message'] = m
+
+        return kind, update
+
+
+def classify(update):
+    if 'edited_message' in update:
+        return 'edit'
+    m = update.get('message', {})
+    if any(e['type'] == 'bot_command' and e['offset'] == 0 for e in m.get('entities', [])):
+        return 'command'
+    if m.get('text') in STATS_BUTTONS:
+        return 'stats'
+    if 'reply_to_message' in m and not any(e['type'] in ('url', 'text_link') for e in m.get('entities', [])):
+        return 'reply'
+    return 'message'
+
+
+def replay(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                update = json.loads(line)
+                yield classify(update), update
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run(stream, total, rate, lanes_count):
+    api = fakebotapi.FakeBotAPI().start()
+    tg = Bot('123456:loadtest', base_url=api.base_url)
+    updater = Updater(bot=tg, use_context=True)
+    dispatcher = updater.dispatcher
+    bot.outbox = sendqueue.SendQueue(tg, private_interval=0, group_interval=0, global_rate=10000)
+    bot.register_handlers(dispatcher)
+    executor = lanes.ShardedExecutor(lanes_count)
+
+    local = threading.local()
+
+    def count_error(update, context):
+        local.errors = getattr(local, 'errors', 0) + 1
+
+    dispatcher.add_error_handler(count_error)
+
+    @event.listens_for(bot.d.engine, 'before_cursor_execute')
+    def count_query(*args):
+        local.queries = getattr(local, 'queries', 0) + 1
+
+    samples = defaultdict(list)
+    lock = threading.Lock()
+    done = threading.Semaphore(0)
+
+    def process(kind, update, enqueued):
+        local.queries = local.errors = 0
+        started = time.perf_counter()
+        dispatcher.process_update(update)
+        finished = time.perf_counter()
+        with lock:
+            samples[kind].append((finished - started, finished - enqueued, local.queries, local.errors))
+        done.release()
+
+    began = time.perf_counter()
+    sent = 0
+    for kind, payload in stream:
+        if sent == total:
+            break
+        if rate:
+            delay = began + sent / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        update = Update.de_json(payload, tg)
+        chat = update.effective_chat
+        executor.submit(chat.id if chat else 0, process, kind, update, time.perf_counter())
+        sent += 1
+
+    for _ in range(sent):
+        done.acquire()
+    elapsed = time.perf_counter() - began
+
+    executor.stop()
+    bot.outbox.stop()
+    api.stop()
+
+    report = {'updates': sent, 'seconds': elapsed, 'throughput': sent / elapsed, 'types': {}}
+    for kind, rows in sorted(samples.items()):
+        handler = [r[0] * 1000 for r in rows]
+        total_latency = [r[1] * 1000 for r in rows]
+        report['types'][kind] = {
+            'count': len(rows),
+            'handler_ms': {p: percentile(handler, p) for p in (50, 90, 99)},
+            'latency_ms': {p: percentile(total_latency, p) for p in (50, 90, 99)},
+            'queries_per_update': sum(r[2] for r in rows) / len(rows),
+            # failed updates are often the fast ones: check before comparing latencies
+            'errors': sum(1 for r in rows if r[3] > 0),
+        }
+    return report
+
+
+def print_report(report):
+    print(f'{report["updates"]} updates in {report["seconds"]:.1f} s: {report["throughput"]:.1f} updates/s')
+    print(f'{"type":<10}{"count":>7}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"lag p99":>10}{"queries":>9}{"errors":>8}')
+    for kind, r in report['types'].items():
+        h = r['handler_ms']
+        print(
+            f'{kind:<10}{r["count"]:>7}{h[50]:>10.2f}{h[90]:>10.2f}{h[99]:>10.2f}'
+            f'{r["latency_ms"][99]:>10.2f}{r["queries_per_update"]:>9.1f}{r["errors"]:>8}'
+        )
+    errors = sum(r['errors'] for r in report['types'].values())
+    if errors > 0:
+        print(f'WARNING: {errors} updates failed, see the log above')
+
+
+def parse_mix(value):
+    return {k: float(v) for k, v in (item.split('=') for item in value.split(','))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay or generate updates against the bot handlers')
+    parser.add_argument('--updates', type=int, default=1000, help='number of updates to send')
+    parser.add_argument('--rate', type=float, default=0, help='updates per second, 0 for as fast as possible')
+    parser.add_argument('--chats', type=int, default=10)
+    parser.add_argument('--users', type=int, default=20, help='users per chat')
+    parser.add_argument('--mix', type=parse_mix, default='message=55,reply=15,edit=10,stats=10,command=10')
+    parser.add_argument('--lanes', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--replay', help='JSON lines file with raw updates instead of generated ones')
+    parser.add_argument('--output', help='also write the report as JSON into this file')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    migrations.migrate(bot.d.engine)
+
+    if args.replay:
+        stream = replay(args.replay)
+    else:
+        generator = Generator(args.chats, args.users, args.mix, args.seed)
+        stream = iter(generator.next, None)
+
+    report = run(stream, args.updates, args.rate, args.lanes)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+import functools
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+import metrics
+
+# Logging for the bot processes.
+#
+# Handler threads only put records on a bounded queue: formatting and writing
+# happen on a background listener thread, and when the writer can't keep up
+# records are dropped (and counted) instead of blocking an update. DEBUG
+# records can be sampled and are rate-limited per logger before anything is
+# formatted. Records logged while handling an update carry its chat, handler
+# and, at the end, the latency (see traced()).
+#
+#     LOG_LEVEL=INFO                                  root level
+#     LOG_LEVELS=telegram=WARNING,db=DEBUG            per-logger levels
+#     LOG_DEBUG_SAMPLE=0.1                            share of DEBUG records kept
+#     LOG_DEBUG_RATE=20                               DEBUG records per second per logger
+#     LOG_SLOW_MS=1000                                updates handled slower are logged as warnings
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s%(context)s'
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def parse_levels(spec):
+    """'telegram=WARNING,db=DEBUG' -> {'telegram': 'WARNING', 'db': 'DEBUG'}"""
+    levels = {}
+    for item in spec.split(','):
+        if item.strip() == '':
+            continue
+        name, _, level = item.partition('=')
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        context = getattr(_local, 'context', None)
+        record.context = (' [' + ' '.join(f'{k}={v}' for k, v in context.items()) + ']') if context else ''
+        return True
+
+
+class DebugSampler(logging.Filter):
+    def __init__(self, sample=1.0, rate=20.0):
+        super().__init__()
+        self.sample = sample
+        self.rate = rate
+        self._buckets = {}  # logger name -> [tokens, last refill]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        if self.sample < 1.0 and random.random() >= self.sample:
+            metrics.inc('log.debug.sampled_out')
+            return False
+
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.setdefault(record.name, [self.rate, now])
+            bucket[0] = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                metrics.inc('log.debug.rate_limited')
+                return False
+            bucket[0] -= 1.0
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc('log.dropped')
+
+
+_handler = None
+_listener = None
+
+
+def _start_listener(capacity):
+    global _listener
+    _handler.queue = queue.Queue(capacity)
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(logging.Formatter(FORMAT))
+    _listener = logging.handlers.QueueListener(_handler.queue, output)
+    _listener.start()
+
+
+def stop():
+    if _listener is not None:
+        _listener.stop()
+
+
+def setup(env=os.environ, capacity=10000):
+    """Routes all logging through the queue; safe to call more than once."""
+    global _handler
+
+    root = logging.getLogger()
+    root.setLevel(env.get('LOG_LEVEL', 'INFO').upper())
+    for name, level in parse_levels(env.get('LOG_LEVELS', '')).items():
+        logging.getLogger(name).setLevel(level)
+
+    if _handler is not None:
+        return
+
+    _handler = _QueueHandler(None)
+    _handler.addFilter(DebugSampler(float(env.get('LOG_DEBUG_SAMPLE', '1')), float(env.get('LOG_DEBUG_RATE', '20'))))
+    _handler.addFilter(ContextFilter())
+    root.handlers = [_handler]
+
+    _start_listener(capacity)
+    # the listener thread doesn't survive a fork (see workqueue.py)
+    os.register_at_fork(after_in_child=lambda: _start_listener(capacity))
+
+
+def traced(callback, slow_ms=None):
+    """Wraps an update handler so that its log records carry the update context."""
+    name = callback.__name__
+    slow_ms = slow_ms if slow_ms is not None else float(os.environ.get('LOG_SLOW_MS', '1000'))
+
+    @functools.wraps(callback)
+    def wrapper(update, context):
+        chat = getattr(update, 'effective_chat', None)
+        outer = getattr(_local, 'context', None)
+        _local.context = {
+            'update': getattr(update, 'update_id', None),
+            'chat': chat.id if chat is not None else None,
+            'handler': name,
+        }
+        started = time.perf_counter()
+        try:
+            return callback(update, context)
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            _local.context['latency_ms'] = f'{elapsed:.1f}'
+            logger.log(logging.WARNING if elapsed > slow_ms else logging.DEBUG, 'Update handled')
+            _local.context = outer
+
+    return wrapper
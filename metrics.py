@@ -0,0 +1,32 @@
+import threading
+
+from collections import defaultdict
+
+# Process-wide counters and gauges. Kept deliberately tiny: values are dumped
+# into the log periodically (see on_log_metrics in hashtagstatsbot.py).
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_gauges = {}
+
+
+def inc(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+
+def snapshot():
+    with _lock:
+        return {**_counters, **_gauges}
+
+
+def format_snapshot():
+    return ' '.join(
+        f'{k}={v:.3f}' if isinstance(v, float) else f'{k}={v}'
+        for k, v in sorted(snapshot().items())
+    )
@@ -0,0 +1,416 @@
+import logging
+import os
+import sys
+
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+
+import db
+
+# Versioned schema migrations.
+#
+# Every step is applied once, in order, inside its own transaction, and
+# recorded in `schema_version`. Steps are plain SQL frozen at the time they
+# were written: never edit an applied step, append a new one instead.
+#
+#     python migrations.py            # apply pending steps
+#     python migrations.py status     # print current and latest versions
+#     python migrations.py rebuild-sketches  # recompute all sketches from the messages
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_LOCK = 0x4855
+
+
+class OutdatedSchema(RuntimeError):
+    pass
+
+
+def _initial_schema(conn):
+    # the schema created by DB.create_all() before migrations were introduced,
+    # hence IF NOT EXISTS everywhere
+    conn.execute(text('''
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_type WHERE typname = 'chat_type') THEN
+                CREATE TYPE chat_type AS ENUM ('private', 'group', 'supergroup', 'channel');
+            END IF;
+        END
+        $$;
+
+        CREATE TABLE IF NOT EXISTS chats (
+            id BIGSERIAL NOT NULL,
+            type chat_type NOT NULL,
+            PRIMARY KEY (id)
+        );
+
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL NOT NULL,
+            first_name VARCHAR NOT NULL,
+            last_name VARCHAR,
+            username VARCHAR,
+            is_bot BOOLEAN DEFAULT 'false',
+            PRIMARY KEY (id)
+        );
+
+        CREATE TABLE IF NOT EXISTS messages (
+            id SERIAL NOT NULL,
+            message_id INTEGER NOT NULL,
+            "from" INTEGER NOT NULL,
+            date TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            chat BIGINT NOT NULL,
+            urls VARCHAR(4096)[],
+            text VARCHAR(4096),
+            PRIMARY KEY (id),
+            UNIQUE (message_id, chat),
+            FOREIGN KEY ("from") REFERENCES users (id),
+            FOREIGN KEY (chat) REFERENCES chats (id)
+        );
+
+        CREATE TABLE IF NOT EXISTS users2hashtags (
+            chat BIGINT NOT NULL,
+            "user" INTEGER NOT NULL,
+            hashtag VARCHAR(255) NOT NULL,
+            PRIMARY KEY (chat, "user", hashtag),
+            FOREIGN KEY (chat) REFERENCES chats (id),
+            FOREIGN KEY ("user") REFERENCES users (id)
+        );
+
+        CREATE TABLE IF NOT EXISTS hashtags (
+            id SERIAL NOT NULL,
+            message INTEGER NOT NULL,
+            linked_message INTEGER,
+            hashtag VARCHAR(255) NOT NULL,
+            PRIMARY KEY (id),
+            UNIQUE (message, hashtag),
+            FOREIGN KEY (message) REFERENCES messages (id),
+            FOREIGN KEY (linked_message) REFERENCES messages (id)
+        );
+    '''))
+
+
+def _update_queue(conn):
+    conn.execute(text('''
+        CREATE TABLE IF NOT EXISTS updates (
+            update_id BIGINT NOT NULL,
+            chat BIGINT,
+            payload JSONB NOT NULL,
+            received TIMESTAMP WITHOUT TIME ZONE DEFAULT now() NOT NULL,
+            processed TIMESTAMP WITHOUT TIME ZONE,
+            PRIMARY KEY (update_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS updates_pending ON updates (update_id) WHERE processed IS NULL;
+    '''))
+
+
+def _chat_hashtags(conn):
+    conn.execute(text('''
+        CREATE TABLE chat_hashtags (
+            chat BIGINT NOT NULL,
+            hashtag VARCHAR(255) NOT NULL,
+            PRIMARY KEY (chat, hashtag),
+            FOREIGN KEY (chat) REFERENCES chats (id)
+        );
+
+        INSERT INTO chat_hashtags (chat, hashtag)
+        SELECT DISTINCT m.chat, h.hashtag
+        FROM hashtags h
+            INNER JOIN messages m ON m.id = h.message;
+    '''))
+
+
+def _sketches(conn):
+    conn.execute(text('''
+        CREATE TABLE tag_sketches (
+            chat BIGINT NOT NULL,
+            hashtag VARCHAR(255) NOT NULL,
+            contributors BYTEA NOT NULL,
+            PRIMARY KEY (chat, hashtag),
+            FOREIGN KEY (chat) REFERENCES chats (id)
+        );
+
+        CREATE TABLE day_sketches (
+            chat BIGINT NOT NULL,
+            day DATE NOT NULL,
+            tags BYTEA NOT NULL,
+            links BYTEA NOT NULL,
+            contributors BYTEA NOT NULL,
+            PRIMARY KEY (chat, day),
+            FOREIGN KEY (chat) REFERENCES chats (id)
+        );
+    '''))
+    db.rebuild_sketches(conn, conn.execution_options(stream_results=True).execute(text('''
+        SELECT m.chat, m.date, m."from", m.urls,
+            (
+                SELECT array_agg(h.hashtag)
+                FROM hashtags h
+                WHERE h.message = m.id
+            ) AS hashtags
+        FROM messages m
+        WHERE m.message_id > 0
+    ''')))
+
+
+def _archive(conn):
+    conn.execute(text('''
+        ALTER TABLE messages ADD COLUMN links INTEGER DEFAULT '0' NOT NULL;
+
+        UPDATE messages
+        SET links = array_length(urls, 1)
+        WHERE array_length(urls, 1) > 0;
+
+        CREATE TABLE messages_archive (
+            message INTEGER NOT NULL,
+            archived TIMESTAMP WITHOUT TIME ZONE DEFAULT now() NOT NULL,
+            urls VARCHAR(4096)[],
+            text VARCHAR(4096),
+            text_z BYTEA,
+            PRIMARY KEY (message),
+            FOREIGN KEY (message) REFERENCES messages (id) ON DELETE CASCADE
+        );
+    '''))
+
+
+PARTITIONS = 8
+
+
+def _fingerprint(conn, query):
+    # order-independent: count and sum of the row hashes
+    return tuple(conn.execute(text(f'''
+        SELECT count(*), coalesce(sum(hashtextextended(t::text, 0)), 0)
+        FROM ({query}) t
+    ''')).first())
+
+
+def _partitioned_messages(conn):
+    # foreign keys referencing a partitioned table need PostgreSQL 12
+    version = int(conn.execute(text('SHOW server_version_num')).scalar())
+    if version < 120000:
+        raise RuntimeError(f'PostgreSQL 12 or newer is required, the server is at {version}')
+
+    # a tag-only reply used to be linked by message_id alone, possibly to a
+    # message of another chat; point those to the message of the same chat
+    fixed = conn.execute(text('''
+        UPDATE hashtags h
+        SET linked_message = (
+            SELECT same.id
+            FROM messages same
+            WHERE same.chat = m.chat
+              AND same.message_id = lm.message_id
+        )
+        FROM messages m, messages lm
+        WHERE m.id = h.message
+          AND lm.id = h.linked_message
+          AND lm.chat <> m.chat
+    ''')).rowcount
+    if fixed > 0:
+        logger.warning('Relinked %d tags to messages of their own chat', fixed)
+
+    messages_columns = 'id, message_id, "from", date, chat, urls, links, text'
+    hashtags_columns = 'id, message, linked_message, hashtag'
+    before = (
+        _fingerprint(conn, f'SELECT {messages_columns} FROM messages'),
+        _fingerprint(conn, f'SELECT {hashtags_columns} FROM hashtags'),
+    )
+
+    conn.execute(text('''
+        ALTER TABLE messages_archive DROP CONSTRAINT messages_archive_message_fkey;
+        ALTER TABLE messages_archive ADD COLUMN chat BIGINT;
+        UPDATE messages_archive a
+        SET chat = m.chat
+        FROM messages m
+        WHERE m.id = a.message;
+        ALTER TABLE messages_archive ALTER COLUMN chat SET NOT NULL;
+
+        ALTER TABLE hashtags RENAME TO hashtags_unpartitioned;
+        ALTER INDEX IF EXISTS hashtags_pkey RENAME TO hashtags_unpartitioned_pkey;
+        ALTER INDEX IF EXISTS hashtags_message_hashtag_key RENAME TO hashtags_unpartitioned_message_hashtag_key;
+        ALTER TABLE messages RENAME TO messages_unpartitioned;
+        ALTER INDEX IF EXISTS messages_pkey RENAME TO messages_unpartitioned_pkey;
+        ALTER INDEX IF EXISTS messages_message_id_chat_key RENAME TO messages_unpartitioned_message_id_chat_key;
+        ALTER SEQUENCE messages_id_seq OWNED BY NONE;
+        ALTER SEQUENCE hashtags_id_seq OWNED BY NONE;
+
+        CREATE TABLE messages (
+            id INTEGER DEFAULT nextval('messages_id_seq') NOT NULL,
+            message_id INTEGER NOT NULL,
+            "from" INTEGER NOT NULL,
+            date TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            chat BIGINT NOT NULL,
+            urls VARCHAR(4096)[],
+            links INTEGER DEFAULT '0' NOT NULL,
+            text VARCHAR(4096),
+            PRIMARY KEY (id, chat),
+            UNIQUE (message_id, chat),
+            FOREIGN KEY ("from") REFERENCES users (id),
+            FOREIGN KEY (chat) REFERENCES chats (id)
+        ) PARTITION BY HASH (chat);
+
+        CREATE TABLE hashtags (
+            id INTEGER DEFAULT nextval('hashtags_id_seq') NOT NULL,
+            chat BIGINT NOT NULL,
+            message INTEGER NOT NULL,
+            linked_message INTEGER,
+            hashtag VARCHAR(255) NOT NULL,
+            PRIMARY KEY (id, chat),
+            UNIQUE (message, hashtag, chat),
+            FOREIGN KEY (message, chat) REFERENCES messages (id, chat),
+            FOREIGN KEY (linked_message, chat) REFERENCES messages (id, chat)
+        ) PARTITION BY HASH (chat);
+
+        ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+        ALTER SEQUENCE hashtags_id_seq OWNED BY hashtags.id;
+    '''))
+
+    # hashtags of a chat live in the partition with the same number as its messages
+    for i in range(PARTITIONS):
+        conn.execute(text(f'''
+            CREATE TABLE messages_{i} PARTITION OF messages FOR VALUES WITH (MODULUS {PARTITIONS}, REMAINDER {i});
+            CREATE TABLE hashtags_{i} PARTITION OF hashtags FOR VALUES WITH (MODULUS {PARTITIONS}, REMAINDER {i});
+        '''))
+
+    conn.execute(text(f'''
+        INSERT INTO messages ({messages_columns})
+        SELECT {messages_columns}
+        FROM messages_unpartitioned;
+
+        INSERT INTO hashtags (chat, {hashtags_columns})
+        SELECT m.chat, h.id, h.message, h.linked_message, h.hashtag
+        FROM hashtags_unpartitioned h
+            INNER JOIN messages_unpartitioned m ON m.id = h.message;
+
+        ALTER TABLE messages_archive ADD FOREIGN KEY (message, chat) REFERENCES messages (id, chat) ON DELETE CASCADE;
+    '''))
+
+    after = (
+        _fingerprint(conn, f'SELECT {messages_columns} FROM messages'),
+        _fingerprint(conn, f'SELECT {hashtags_columns} FROM hashtags'),
+    )
+    if after != before:
+        raise RuntimeError(f'Partitioned tables differ from the originals: {before} before, {after} after')
+
+    conn.execute(text('''
+        DROP TABLE hashtags_unpartitioned;
+        DROP TABLE messages_unpartitioned;
+
+        ANALYZE messages;
+        ANALYZE hashtags;
+    '''))
+
+
+def _period_sketches(conn):
+    conn.execute(text('''
+        CREATE TABLE period_sketches (
+            chat BIGINT NOT NULL,
+            period VARCHAR(5) NOT NULL,
+            start DATE NOT NULL,
+            tags BYTEA NOT NULL,
+            links BYTEA NOT NULL,
+            contributors BYTEA NOT NULL,
+            PRIMARY KEY (chat, period, start),
+            FOREIGN KEY (chat) REFERENCES chats (id)
+        );
+    '''))
+    db.roll_up_sketches(conn)
+
+
+MIGRATIONS = [
+    (1, 'initial schema', _initial_schema),
+    (2, 'update queue', _update_queue),
+    (3, 'distinct tags per chat', _chat_hashtags),
+    (4, 'cardinality sketches', _sketches),
+    (5, 'message archive', _archive),
+    (6, 'messages and hashtags partitioned by chat', _partitioned_messages),
+    (7, 'month and year sketches', _period_sketches),
+]
+
+LATEST = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    try:
+        return conn.execute(text('SELECT max(version) FROM schema_version')).scalar() or 0
+    except ProgrammingError:
+        return 0
+
+
+def check(engine):
+    """The only schema work done on startup: one query."""
+    with engine.connect() as conn:
+        version = current_version(conn)
+
+    if version < LATEST:
+        raise OutdatedSchema(
+            f'Database schema is at version {version}, but {LATEST} is required. '
+            'Run "python migrations.py" first.'
+        )
+    return version
+
+
+def migrate(engine):
+    with engine.connect() as conn:
+        # keep concurrent deploys from applying the same steps twice
+        conn.execute(text('SELECT pg_advisory_lock(:key)'), key=MIGRATION_LOCK)
+        try:
+            with conn.begin():
+                conn.execute(text('''
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER NOT NULL,
+                        description VARCHAR NOT NULL,
+                        applied TIMESTAMP WITHOUT TIME ZONE DEFAULT now() NOT NULL,
+                        PRIMARY KEY (version)
+                    )
+                '''))
+                version = conn.execute(text('SELECT max(version) FROM schema_version')).scalar() or 0
+
+            for step, description, apply in MIGRATIONS:
+                if step <= version:
+                    continue
+
+                logger.info('Applying migration %d: %s', step, description)
+                with conn.begin():
+                    apply(conn)
+                    conn.execute(
+                        text('INSERT INTO schema_version (version, description) VALUES (:version, :description)'),
+                        version=step, description=description
+                    )
+                version = step
+        finally:
+            conn.execute(text('SELECT pg_advisory_unlock(:key)'), key=MIGRATION_LOCK)
+
+    return version
+
+
+def rebuild_sketches(engine):
+    """For data loaded around the bot (e.g. by dumpchat.py), whose sketches
+    were never updated."""
+    check(engine)
+    with engine.begin() as conn:
+        db.rebuild_sketches(conn)
+        db.roll_up_sketches(conn)
+
+
+def main(argv):
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    d = db.DB(full_uri=os.environ['DATABASE_URL'])
+    command = argv[0] if len(argv) > 0 else 'migrate'
+
+    if command == 'migrate':
+        print(f'Schema is at version {migrate(d.engine)}')
+    elif command == 'status':
+        with d.engine.connect() as conn:
+            print(f'Schema is at version {current_version(conn)}, latest is {LATEST}')
+    elif command == 'rebuild-sketches':
+        rebuild_sketches(d.engine)
+        print('Sketches rebuilt')
+    else:
+        print('Usage: python migrations.py [migrate|status|rebuild-sketches]')
+        return 2
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,155 @@
+import collections
+import os
+import re
+import sys
+import threading
+import time
+
+# A sampling profiler for the running bot.
+#
+# While it runs, a background thread looks at the stacks of the other
+# threads (sys._current_frames) every `interval` seconds, so the profiled
+# code isn't instrumented and pays next to nothing. Samples of threads
+# waiting for work (the loops in IDLE_LOOPS) are counted as idle and left
+# out; a thread blocked in a DB or Telegram call, or waiting for a pooled
+# connection, is busy, as that is where the time goes. The result is a
+# collapsed-stack file, one line per distinct stack
+#
+#     lane-N;hashtagstatsbot.on_new_message;db.DB.add_message;... 42
+#
+# which flamegraph.pl or speedscope.app turn into a flame graph, and a
+# summary of the functions and modules seen most.
+#
+# See /profile and SIGUSR1 in hashtagstatsbot.py.
+
+WAIT_MODULES = {'threading', 'queue'}
+
+# where the bot's threads wait (or sleep) for the next update, job or message
+# to send, as (module, function): labels only include the class on 3.11+
+IDLE_LOOPS = {
+    ('lanes', '_run'),
+    ('sendqueue', '_take'),
+    ('telegram.ext.dispatcher', 'start'),
+    ('telegram.ext.dispatcher', '_pooled'),
+    ('telegram.ext.jobqueue', '_main_loop'),
+    ('telegram.ext.updater', 'idle'),
+    ('workqueue', 'run_worker'),
+}
+
+_running = threading.Lock()
+
+
+def _thread_group(name):
+    # lane-3 -> lane-N, Bot:123:worker:0 -> Bot:N:worker:N
+    return re.sub(r'\d+', 'N', name)
+
+
+class Profile(object):
+    def __init__(self, seconds, interval):
+        self.seconds = seconds
+        self.interval = interval
+        self.stacks = collections.Counter()  # (thread group, frame, ...) -> samples
+        self.idle = 0
+        self.loops = set()  # labels of the IDLE_LOOPS seen
+
+    @property
+    def busy(self):
+        return sum(self.stacks.values())
+
+    def collapsed(self):
+        return ''.join(f'{";".join(stack)} {n}\n' for stack, n in self.stacks.most_common())
+
+    def top(self, limit=15, by_self=False):
+        """[(function, share of busy samples within it, share on top of the stack)],
+        without the thread loops every stack goes through."""
+        total, own = collections.Counter(), collections.Counter()
+        for stack, n in self.stacks.items():
+            for frame in set(stack[1:]):
+                if frame not in self.loops and frame.split('.', 1)[0] not in WAIT_MODULES:
+                    total[frame] += n
+            own[stack[-1]] += n
+        busy = max(1, self.busy)
+        ranked = own if by_self else total
+        return [(f, total[f] / busy, own[f] / busy) for f, _ in ranked.most_common(limit)]
+
+    def modules(self, limit=8):
+        """[(top-level module, share of busy samples within it)]"""
+        total = collections.Counter()
+        for stack, n in self.stacks.items():
+            for module in {frame.split('.', 1)[0] for frame in stack[1:]}:
+                total[module] += n
+        busy = max(1, self.busy)
+        return [(m, n / busy) for m, n in total.most_common(limit)]
+
+    def summary(self, limit=15):
+        samples = self.busy + self.idle
+        lines = [
+            f'{self.seconds:.0f} s, {samples} samples every {self.interval * 1000:.0f} ms, '
+            f'{self.busy / max(1, samples):.0%} busy',
+        ]
+        for by_self in (False, True):
+            lines += ['', f'{"total":>6} {"self":>6}  function']
+            lines += [f'{total:>6.1%} {own:>6.1%}  {f}' for f, total, own in self.top(limit, by_self)]
+        lines += ['', ', '.join(f'{m} {share:.0%}' for m, share in self.modules())]
+        return '\n'.join(lines)
+
+
+def _label(frame, labels):
+    """(label, whether it is one of IDLE_LOOPS)"""
+    code = frame.f_code
+    label = labels.get(code)
+    if label is None:
+        module = frame.f_globals.get('__name__', '?')
+        if module == '__main__':
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        # co_qualname (3.11+) includes the class, e.g. db.DB.add_message
+        label = labels[code] = (
+            f'{module}.{getattr(code, "co_qualname", code.co_name)}',
+            (module, code.co_name) in IDLE_LOOPS
+        )
+    return label
+
+
+def sample(seconds, interval=0.01, threads=None):
+    """Samples the stacks of the threads whose name matches `threads` (a regex,
+    all but the sampling one by default) for `seconds`.
+
+    Returns a Profile, or None if another profile is already being taken."""
+    if not _running.acquire(blocking=False):
+        return None
+
+    try:
+        profile = Profile(seconds, interval)
+        labels = {}  # code object -> (label, whether it is an idle loop)
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident)
+                if ident == me or name is None or (threads is not None and not threads.match(name)):
+                    continue
+
+                stack, loops = [], []
+                while frame is not None:
+                    label, loop = _label(frame, labels)
+                    stack.append(label)
+                    if loop:
+                        loops.append(label)
+                    frame = frame.f_back
+
+                waiting = 0
+                while waiting < len(stack) and stack[waiting].split('.', 1)[0] in WAIT_MODULES:
+                    waiting += 1
+                if waiting < len(stack) and stack[waiting] in loops:
+                    profile.idle += 1
+                    continue
+
+                profile.loops.update(loops)
+                stack.append(_thread_group(name))
+                profile.stacks[tuple(reversed(stack))] += 1
+
+            time.sleep(interval)
+        return profile
+    finally:
+        _running.release()
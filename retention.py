@@ -0,0 +1,73 @@
+import argparse
+import datetime
+import logging
+import os
+import sys
+import threading
+import time
+
+import db
+
+# Retention of the hot messages table.
+#
+# The reports only need the narrow columns of messages (links is a counter
+# of the urls), so text and urls of messages older than the retention age
+# are moved to messages_archive in small batches, each in its own short
+# transaction. Edits bring a message back (see DB.add_message), and the
+# exports, snapshots and sketches read through the archive.
+#
+#     python retention.py --days 180 --compress
+
+logger = logging.getLogger(__name__)
+
+_running = threading.Lock()
+
+
+def archive(d, older_than, *, batch_size=1000, compress=False, pause=0.1, progress=logger.info):
+    """Archives everything older than `older_than`; returns the number of archived messages."""
+    if not _running.acquire(blocking=False):
+        progress('Archiving is already in progress')
+        return 0
+
+    try:
+        before = datetime.datetime.utcnow() - older_than
+        total = d.archivable(before)
+        progress(f'{total} messages older than {before:%Y-%m-%d %H:%M} to archive')
+
+        done, last_id, started = 0, 0, time.monotonic()
+        while True:
+            archived, last_id = d.archive_messages(before, last_id, batch_size, compress=compress)
+            if archived == 0:
+                break
+
+            done += archived
+            progress(
+                f'Archived {done}/{total} ({100 * done / max(total, done):.0f}%), '
+                f'{done / (time.monotonic() - started):.0f} messages/s'
+            )
+            time.sleep(pause)
+
+        progress(f'Done in {time.monotonic() - started:.1f} s')
+        return done
+    finally:
+        _running.release()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move text and urls of old messages to the archive')
+    parser.add_argument('--days', type=int, default=int(os.environ.get('RETENTION_DAYS', '180')))
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--compress', action='store_true', help='store the archived text zlib-compressed')
+    parser.add_argument('--pause', type=float, default=0.1, help='seconds to sleep between batches')
+    args = parser.parse_args()
+
+    d = db.DB(full_uri=os.environ['DATABASE_URL'])
+    archive(
+        d, datetime.timedelta(days=args.days),
+        batch_size=args.batch_size, compress=args.compress, pause=args.pause, progress=print
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+
+from collections import OrderedDict, deque
+
+from telegram import Chat, ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, TimedOut
+
+import metrics
+
+# Outbound queue for everything the bot sends.
+#
+# Handlers only enqueue and return. A few sender threads deliver the calls
+# while keeping Telegram's limits: messages of one chat go out in order and
+# no faster than one per `private_interval` (private chats) or
+# `group_interval` (groups), and no more than `global_rate` per second in
+# total. Flood waits (429) and network errors are retried with backoff, and
+# identical messages to the same chat within `coalesce_window` are dropped.
+
+logger = logging.getLogger(__name__)
+
+
+class SendQueue(object):
+    def __init__(self, bot, *, senders=4, private_interval=1.0, group_interval=3.0,
+                 global_rate=30, coalesce_window=10.0, max_retries=5):
+        self.bot = bot
+        self.private_interval = private_interval
+        self.group_interval = group_interval
+        self.global_interval = 1.0 / global_rate
+        self.coalesce_window = coalesce_window
+        self.max_retries = max_retries
+
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()  # chat id -> deque of calls
+        self._ready_at = {}            # chat id -> earliest time of the next call
+        self._in_flight = set()
+        self._recent = {}              # coalescing key -> time it was enqueued
+        self._next_global = 0.0
+        self._stopped = False
+
+        self._threads = [
+            threading.Thread(target=self._run, name=f'sender-{i}', daemon=True)
+            for i in range(senders)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def call(self, chat, method, key=None, throttle=True, **kwargs):
+        """Enqueue `bot.<method>(**kwargs)` behind everything else queued for the chat.
+
+        `chat` only picks the queue, the bot method gets its own chat_id in kwargs.
+
+        Calls with `throttle` off (e.g. answering a callback query) don't delay
+        the next call to the chat.
+        """
+        now = time.monotonic()
+        with self._cond:
+            if key is not None:
+                key = (chat, method, key)
+                if now - self._recent.get(key, float('-inf')) < self.coalesce_window:
+                    metrics.inc('sendqueue.coalesced')
+                    return
+                self._recent = {
+                    k: t for k, t in self._recent.items()
+                    if now - t < self.coalesce_window
+                }
+                self._recent[key] = now
+
+            self._pending.setdefault(chat, deque()).append([method, kwargs, 0, throttle])
+            metrics.inc('sendqueue.enqueued')
+            self._cond.notify()
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.call(chat_id, 'send_message', key=text, chat_id=chat_id, text=text, **kwargs)
+
+    def reply_text(self, message, text, **kwargs):
+        # same quoting rules as telegram.Message.reply_text
+        if message.chat.type != Chat.PRIVATE:
+            kwargs.setdefault('reply_to_message_id', message.message_id)
+        self.send_message(message.chat_id, text, **kwargs)
+
+    def reply_markdown(self, message, text, **kwargs):
+        self.reply_text(message, text, parse_mode=ParseMode.MARKDOWN, **kwargs)
+
+    def edit_message_text(self, message, text, **kwargs):
+        self.call(
+            message.chat_id, 'edit_message_text',
+            chat_id=message.chat_id, message_id=message.message_id, text=text, **kwargs
+        )
+
+    def send_document(self, chat_id, data, filename, **kwargs):
+        self.call(
+            chat_id, 'send_document',
+            chat_id=chat_id, document=_Upload(data, filename), filename=filename, **kwargs
+        )
+
+    def answer_callback_query(self, query, **kwargs):
+        self.call(
+            query.message.chat_id, 'answer_callback_query', throttle=False,
+            callback_query_id=query.id, **kwargs
+        )
+
+    def depth(self):
+        with self._cond:
+            return sum(len(q) for q in self._pending.values())
+
+    def _interval(self, chat_id):
+        return self.private_interval if chat_id > 0 else self.group_interval
+
+    def _take(self):
+        """Wait for the next chat allowed to send; returns (chat_id, call)."""
+        with self._cond:
+            while True:
+                if self._stopped and not self._pending:
+                    return None, None
+
+                now = time.monotonic()
+                wait = None
+                for chat_id, calls in self._pending.items():
+                    if chat_id in self._in_flight:
+                        continue
+                    ready = max(self._ready_at.get(chat_id, 0.0), self._next_global)
+                    if ready <= now:
+                        self._in_flight.add(chat_id)
+                        self._next_global = now + self.global_interval
+                        return chat_id, calls[0]
+                    wait = ready - now if wait is None else min(wait, ready - now)
+
+                self._cond.wait(wait)
+
+    def _done(self, chat_id, delay, retry):
+        with self._cond:
+            now = time.monotonic()
+            self._in_flight.discard(chat_id)
+            if len(self._ready_at) > 10000:
+                self._ready_at = {c: t for c, t in self._ready_at.items() if t > now}
+            self._ready_at[chat_id] = now + delay
+            if not retry:
+                calls = self._pending[chat_id]
+                calls.popleft()
+                if len(calls) == 0:
+                    del self._pending[chat_id]
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            chat_id, call = self._take()
+            if chat_id is None:
+                return
+
+            method, kwargs, attempt, throttle = call
+            delay, retry = self._interval(chat_id) if throttle else 0.0, False
+            try:
+                getattr(self.bot, method)(**kwargs)
+                metrics.inc('sendqueue.sent')
+            except RetryAfter as e:
+                metrics.inc('sendqueue.flood_wait')
+                delay, retry = e.retry_after, True
+            except BadRequest as e:
+                # a subclass of NetworkError, but retrying won't help
+                metrics.inc('sendqueue.dropped')
+                logger.error('Failed to %s to %s: %s', method, chat_id, e)
+            except (TimedOut, NetworkError) as e:
+                if attempt < self.max_retries:
+                    metrics.inc('sendqueue.retried')
+                    delay, retry = 2 ** attempt, True
+                else:
+                    metrics.inc('sendqueue.dropped')
+                    logger.error('Giving up on %s to %s: %s', method, chat_id, e)
+            except TelegramError as e:
+                metrics.inc('sendqueue.dropped')
+                logger.error('Failed to %s to %s: %s', method, chat_id, e)
+
+            call[2] = attempt + 1
+            self._done(chat_id, delay, retry)
+
+    def stop(self, timeout=10.0):
+        """Deliver what is still pending (for up to `timeout` seconds) and stop."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+
+
+class _Upload(object):
+    # read again on every attempt, unlike a file object
+    def __init__(self, data, name):
+        self.data = data
+        self.name = name
+
+    def read(self):
+        return self.data
@@ -0,0 +1,114 @@
+import bisect
+import threading
+
+from collections import Counter
+
+# In-process index of the tags known in every chat.
+#
+# Answers "was this tag ever used here?" without touching the database and
+# suggests near-misses for typos: tags with similar trigrams first, then tags
+# sharing the prefix. Also lists the first letters of the tags, for the
+# jump-to-letter buttons of the tag listing. A chat is loaded on first use
+# and kept current by add() on ingest; updates of one chat are handled by
+# one process (see lanes.py and workqueue.py), so there is nothing to
+# invalidate.
+
+
+def trigrams(tag):
+    word = f'  {tag.lstrip("#").lower()} '
+    return {word[i : i + 3] for i in range(len(word) - 2)}
+
+
+def initial(tag):
+    return tag.lstrip('#')[:1].lower()
+
+
+class _ChatTags(object):
+    def __init__(self, tags):
+        self.tags = set()
+        self.lowered = []
+        self.trigrams = {}
+        self.sizes = {}
+        self.initials = Counter()  # first letter -> tags
+        self.add(tags)
+
+    def add(self, tags):
+        for tag in tags:
+            if tag in self.tags:
+                continue
+            self.tags.add(tag)
+            bisect.insort(self.lowered, (tag.lower(), tag))
+            self.initials[initial(tag)] += 1
+            grams = trigrams(tag)
+            self.sizes[tag] = len(grams)
+            for t in grams:
+                self.trigrams.setdefault(t, set()).add(tag)
+
+    def by_prefix(self, prefix, limit):
+        prefix = prefix.lower()
+        found = []
+        i = bisect.bisect_left(self.lowered, (prefix, ''))
+        while i < len(self.lowered) and len(found) < limit:
+            lowered, tag = self.lowered[i]
+            if not lowered.startswith(prefix):
+                break
+            found.append(tag)
+            i += 1
+        return found
+
+    def similar(self, tag, limit, threshold=0.25):
+        wanted = trigrams(tag)
+        shared = Counter()
+        for t in wanted:
+            shared.update(self.trigrams.get(t, ()))
+
+        scored = []
+        for candidate, n in shared.items():
+            score = n / (len(wanted) + self.sizes[candidate] - n)
+            if score >= threshold:
+                scored.append((-score, candidate))
+        return [c for _, c in sorted(scored)[:limit]]
+
+
+class TagIndex(object):
+    def __init__(self, load):
+        """`load(chat_id)` returns all tags of a chat."""
+        self._load = load
+        self._chats = {}
+        self._lock = threading.Lock()
+
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = _ChatTags(self._load(chat_id))
+            with self._lock:
+                chat = self._chats.setdefault(chat_id, chat)
+        return chat
+
+    def add(self, chat_id, tags):
+        chat = self._chats.get(chat_id)
+        if chat is not None:
+            with self._lock:
+                chat.add(tags)
+
+    def known(self, chat_id, tag):
+        return tag in self._chat(chat_id).tags
+
+    def initials(self, chat_id, excluded=()):
+        """Sorted lowercased first letters of the tags of a chat but `excluded`."""
+        chat = self._chat(chat_id)
+        with self._lock:
+            counts = chat.initials.copy()
+            counts.subtract(initial(t) for t in excluded if t in chat.tags)
+        return sorted(i for i, n in counts.items() if n > 0 and i)
+
+    def suggest(self, chat_id, tag, limit=5):
+        chat = self._chat(chat_id)
+        with self._lock:
+            found = chat.similar(tag, limit)
+            for t in chat.by_prefix(tag, limit):
+                if len(found) == limit:
+                    break
+                if t not in found:
+                    found.append(t)
+        return found
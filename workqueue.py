@@ -0,0 +1,105 @@
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import time
+
+from sqlalchemy import func, select, text
+from telegram import Update
+from telegram.ext import Updater
+
+import hashtagstatsbot as bot
+import sendqueue
+
+# Workers for the queued ingestion mode.
+#
+# With UPDATE_QUEUE=1 the webhook process only stores incoming updates in the
+# `updates` table (deduplicated by update_id). Each worker here owns one shard
+# of chats (chat id modulo number of shards) and replays its updates strictly
+# in update_id order, so an edit can never overtake the original message.
+#
+# A shard is owned through an advisory lock keyed on the shard and the number
+# of shards. A worker waits while its shard is owned by another one (e.g. the
+# old worker during a rolling deploy), and also while workers started with a
+# different number of shards are running, as their shards overlap with its own.
+
+logger = logging.getLogger(__name__)
+
+SHARD_LOCK = 0x4854
+
+
+def acquire_shard(conn, shard, shards, retry_interval=5.0):
+    """Blocks until the shard is owned on `conn`."""
+    key = shards << 16 | shard
+    while True:
+        if conn.execute(select([func.pg_try_advisory_lock(SHARD_LOCK, key)])).scalar():
+            others = [r[0] for r in conn.execute(text('''
+                SELECT DISTINCT l.objid::bigint >> 16
+                FROM pg_locks l
+                WHERE l.locktype = 'advisory'
+                  AND l.database = (SELECT oid FROM pg_database WHERE datname = current_database())
+                  AND l.classid = :lock
+                  AND l.objsubid = 2
+                  AND l.granted
+                  AND l.objid::bigint >> 16 <> :shards
+            '''), lock=SHARD_LOCK, shards=shards)]
+            if len(others) == 0:
+                return
+
+            conn.execute(select([func.pg_advisory_unlock(SHARD_LOCK, key)]))
+            logger.warning('Workers with %s shards are still running, waiting for them to stop', others)
+        else:
+            logger.info('Shard %d/%d is served by another worker, waiting for it', shard, shards)
+        # jittered, so that workers with different shard counts don't back off in lockstep
+        time.sleep(retry_interval * (0.5 + random.random()))
+
+
+def run_worker(shard, shards, poll_interval=0.5, batch_size=100):
+    # not the forwarding one inherited from main()
+    signal.signal(signal.SIGUSR1, bot.on_profile_signal)
+    # never share pooled connections with the parent process
+    bot.d.engine.dispose()
+
+    updater = Updater(token=os.environ['TG_TOKEN'], base_url=os.environ.get('TG_BASE_URL'), use_context=True)
+    bot.outbox = sendqueue.SendQueue(updater.bot)
+    dispatcher = updater.dispatcher
+    bot.register_handlers(dispatcher)
+    updater.job_queue.start()
+
+    with bot.d.engine.connect() as lock:
+        acquire_shard(lock, shard, shards)
+        logger.info('Serving shard %d/%d', shard, shards)
+        while True:
+            pending = bot.d.pending_updates(shard, shards, batch_size).fetchall()
+            if len(pending) == 0:
+                time.sleep(poll_interval)
+                continue
+
+            for u in pending:
+                dispatcher.process_update(Update.de_json(u['payload'], dispatcher.bot))
+                bot.d.mark_update_processed(u['update_id'])
+
+
+def main(shards):
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(shard, shards), name=f'worker-{shard}')
+        for shard in range(shards)
+    ]
+    for w in workers:
+        w.start()
+
+    def forward(signum, frame):
+        # kill -USR1 <pid>: every worker profiles itself (see hashtagstatsbot.on_profile_signal)
+        for w in workers:
+            if w.is_alive():
+                os.kill(w.pid, signum)
+
+    signal.signal(signal.SIGUSR1, forward)
+    for w in workers:
+        w.join()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else int(os.environ.get('QUEUE_WORKERS', '2')))